@@ -14,102 +14,76 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>. 
 
-from flask import Flask, request
+from flask import Flask, Request, request
+from werkzeug.exceptions import RequestEntityTooLarge
 import os
-import re
 from email_processor import process_and_reply_to_email
 from utils import debug_print
-from config import load_configuration, EmailProcessingError
+from config import get_configuration, install_reload_signal
+from inbound import accept_inbound
+import job_queue
+import dedup
+import metrics
+from attachments import CappedSpooledFile
+
+class InboundRequest(Request):
+    # Cap each attachment while the multipart body is being read, rather than
+    # after it has already been buffered
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return CappedSpooledFile(config['MAX_ATTACHMENT_BYTES'])
+
+    @property
+    def max_content_length(self):
+        return config['MAX_MESSAGE_BYTES']
+
+    @property
+    def max_form_memory_size(self):
+        return config['MAX_FORM_FIELD_BYTES']
 
 app = Flask(__name__)
-config = load_configuration()
+app.request_class = InboundRequest
+config = get_configuration()
+
+def start_background_services():
+    install_reload_signal()
+    job_queue.init_queue(config)
+    dedup.init_dedup(config)
+    if config['QUEUE_WORKERS_ENABLED']:
+        job_queue.start_worker_thread(config, process_and_reply_to_email)
+
+# Not at import time unconditionally: the image pool and attachment text
+# extraction spawn processes that re-import this file as __mp_main__ when
+# it's run directly, and each of them would start its own queue workers.
+# Imported by a WSGI server (gunicorn app:app) the module is named 'app'; run
+# directly, the services start below, in the process that serves requests.
+if __name__ == 'app':
+    start_background_services()
 
 @app.route('/inbound', methods=['POST'])
-async def inbound_parse():
+def inbound_parse():
     try:
-        sender = request.form.get('from', '')
-        subject = request.form.get('subject', '')
-        original_message_id = request.form.get('Message-ID') or request.form.get('message-id')
-        references = request.form.get('References', '')
-        
-        if original_message_id:
-            thread_references = f"{references} {original_message_id}" if references else original_message_id
-        else:
-            thread_references = None
-
         debug_print("\n=== Incoming Request ===")
         debug_print("Headers:", dict(request.headers))
-        debug_print("Form data:", dict(request.form))
-        debug_print("Files:", len(request.files))
-
-        text = request.form.get('text', '')
-        html = request.form.get('html', '')
-        to = request.form.get('to', '')
-        
-        debug_print("\n=== Email Content Debug ===")
-        debug_print("Text content:")
-        debug_print(text)
-        debug_print("\nHTML content:")
-        debug_print(html)
-        debug_print("=========================\n")
-        
-        if text:
-            try:
-                if isinstance(text, bytes):
-                    text.decode('utf-8')
-                else:
-                    text.encode('utf-8').decode('utf-8')
-                content = text.strip()
-            except UnicodeError:
-                content = "No text content provided"
-        elif html:
-            content = re.sub('<[^<]+?>', '', html).strip()
-        else:
-            content = "No text content provided"
-        
-        attachments = []
-        for filename, file in request.files.items():
-            try:
-                content_bytes = file.read()
-                content_type = file.content_type if hasattr(file, 'content_type') else None
-                attachments.append({
-                    'filename': filename,
-                    'content': content_bytes,
-                    'content_type': content_type
-                })
-                debug_print(f"Processed attachment: {filename} (size: {len(content_bytes)} bytes)")
-            except Exception as e:
-                debug_print(f"Error processing attachment {filename}: {str(e)}")
-        
-        success, message, status_code = await process_and_reply_to_email(
-            from_email=sender,
-            to_email=to,
-            subject=subject,
-            text_content=content,
-            message_id=original_message_id,
-            references=thread_references,
-            attachments=attachments if attachments else None,
-            cc_addresses=request.form.get('cc', '')
-        )
-        
-        if success:
-            return "OK", 200
-        else:
-            return message, status_code
-            
-    except Exception as e:
-        error_msg = f"Error processing inbound email: {str(e)}"
-        debug_print(error_msg)
-        import traceback
-        debug_print(traceback.format_exc())
-        return error_msg, 400
+        form, files = request.form, request.files
+    except RequestEntityTooLarge:
+        debug_print("Rejected inbound email over MAX_MESSAGE_BYTES")
+        return "Email too large", 413
+    return accept_inbound(config, form, files)
 
 @app.route('/ping', methods=['GET'])
 def ping():
     return "OK", 200
 
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return metrics.render(), 200, {'Content-Type': metrics.CONTENT_TYPE}
+
 if __name__ == '__main__':
     debug = os.getenv("FLASK_DEBUG") == "1"
+    # With debug on, the reloader's parent process only watches files; the
+    # child it restarts on every change is the one that serves requests
+    if not debug or os.getenv('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_services()
     if os.getenv('FLASK_ENV') == 'development':
         app.run(debug=debug, port=5001, host='0.0.0.0') 
     else:
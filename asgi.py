@@ -0,0 +1,149 @@
+# Mentat Mail: https://andybromberg.com/mentat-mail
+# Copyright (C) 2025 Andy Bromberg andy@andybromberg.com
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import tempfile
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.formparser import FormDataParser
+from werkzeug.http import parse_options_header
+from email_processor import process_and_reply_to_email
+from utils import debug_print
+from config import get_configuration, install_reload_signal
+from inbound import accept_inbound
+from attachments import CappedSpooledFile, SPOOL_MEMORY_BYTES
+import job_queue
+import dedup
+import delivery
+import metrics
+
+# ASGI entry point for production: uvicorn asgi:app
+#
+# Same /inbound and /ping contract as app.py, but the webhook handler, the
+# job queue workers and every LLM and SendGrid call share one event loop per
+# process, so a single process can keep hundreds of model calls in flight.
+# Blocking work (form parsing, SQLite, spool files) runs in threads.
+
+config = get_configuration()
+_workers = None
+
+async def _respond(send, status, body, content_type='text/html; charset=utf-8'):
+    body = body.encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', content_type.encode('ascii')),
+            (b'content-length', str(len(body)).encode('ascii'))
+        ]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+async def _read_body(receive, max_bytes):
+    # Spool the request body as it arrives; returns None once it's over max_bytes
+    body = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_BYTES)
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            body.close()
+            return None
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > max_bytes:
+            body.close()
+            return None
+        body.write(chunk)
+        if not message.get('more_body', False):
+            break
+    body.seek(0)
+    return body, size
+
+def _parse_and_accept(body, size, content_type):
+    parser = FormDataParser(
+        stream_factory=lambda *args, **kwargs: CappedSpooledFile(config['MAX_ATTACHMENT_BYTES']),
+        max_form_memory_size=config['MAX_FORM_FIELD_BYTES'],
+        max_content_length=config['MAX_MESSAGE_BYTES']
+    )
+    mimetype, options = parse_options_header(content_type)
+    try:
+        _, form, files = parser.parse(body, mimetype, size, options)
+        return accept_inbound(config, form, files)
+    finally:
+        body.close()
+
+async def inbound_parse(scope, receive, send):
+    headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+    debug_print("\n=== Incoming Request ===")
+    debug_print("Headers:", headers)
+
+    declared = headers.get('content-length', '')
+    if declared.isdigit() and int(declared) > config['MAX_MESSAGE_BYTES']:
+        debug_print("Rejected inbound email over MAX_MESSAGE_BYTES")
+        return await _respond(send, 413, "Email too large")
+    received = await _read_body(receive, config['MAX_MESSAGE_BYTES'])
+    if received is None:
+        debug_print("Rejected inbound email over MAX_MESSAGE_BYTES")
+        return await _respond(send, 413, "Email too large")
+
+    body, size = received
+    try:
+        message, status = await asyncio.to_thread(_parse_and_accept, body, size, headers.get('content-type', ''))
+    except RequestEntityTooLarge:
+        debug_print("Rejected inbound email with a form field over MAX_FORM_FIELD_BYTES")
+        message, status = "Email too large", 413
+    await _respond(send, status, message)
+
+async def _lifespan(receive, send):
+    global _workers
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                install_reload_signal()
+                job_queue.init_queue(config)
+                dedup.init_dedup(config)
+                if config['QUEUE_WORKERS_ENABLED']:
+                    _workers = asyncio.create_task(job_queue.run_workers(config, process_and_reply_to_email))
+            except Exception as e:
+                await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if _workers is not None:
+                _workers.cancel()
+                await asyncio.gather(_workers, return_exceptions=True)
+            await delivery.close_clients()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    routes = {'/inbound': 'POST', '/ping': 'GET', '/metrics': 'GET'}
+    path = scope['path']
+    if path not in routes:
+        return await _respond(send, 404, "Not Found")
+    if scope['method'] != routes[path] and not (routes[path] == 'GET' and scope['method'] == 'HEAD'):
+        return await _respond(send, 405, "Method Not Allowed")
+
+    if path == '/inbound':
+        return await inbound_parse(scope, receive, send)
+    if path == '/metrics':
+        return await _respond(send, 200, metrics.render(), metrics.CONTENT_TYPE)
+    await _respond(send, 200, "OK")
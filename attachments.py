@@ -0,0 +1,148 @@
+# Mentat Mail: https://mentatmail.com
+# Copyright (C) 2025 Andy Bromberg andy@andybromberg.com
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import io
+import os
+import base64
+import asyncio
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# Small uploads stay in memory, anything bigger goes to a temp file
+SPOOL_MEMORY_BYTES = 512 * 1024
+# Multiple of 3 so each chunk encodes to base64 without padding
+ENCODE_CHUNK_BYTES = 3 * 256 * 1024
+# Image formats every vision provider we support accepts as-is
+PROVIDER_IMAGE_FORMATS = {'JPEG': 'image/jpeg', 'PNG': 'image/png', 'GIF': 'image/gif', 'WEBP': 'image/webp'}
+
+_image_pool = None
+
+class CappedSpooledFile:
+    # Upload stream handed to the multipart parser. Once an attachment goes
+    # over max_bytes we throw away what we have and stop storing, but keep
+    # accepting writes so the rest of the email still parses.
+    def __init__(self, max_bytes):
+        self._file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_BYTES)
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.oversized = False
+
+    def write(self, data):
+        if not self.oversized:
+            if self.size + len(data) > self.max_bytes:
+                self.oversized = True
+                self._file.seek(0)
+                self._file.truncate()
+            else:
+                self._file.write(data)
+        self.size += len(data)
+        return len(data)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+def open_attachment(attachment):
+    if attachment.get('path'):
+        return open(attachment['path'], 'rb')
+    return io.BytesIO(attachment.get('content') or b'')
+
+def attachment_size(attachment):
+    if 'size' in attachment:
+        return attachment['size']
+    if attachment.get('path'):
+        return os.path.getsize(attachment['path'])
+    return len(attachment.get('content') or b'')
+
+def encode_data_url(attachment, mime_type):
+    # Encode straight from the spooled file so we never hold the raw bytes and
+    # their base64 copy at the same time.
+    parts = [f"data:{mime_type};base64,"]
+    with open_attachment(attachment) as f:
+        while True:
+            chunk = f.read(ENCODE_CHUNK_BYTES)
+            if not chunk:
+                break
+            parts.append(base64.b64encode(chunk).decode('ascii'))
+    return ''.join(parts)
+
+def prepare_image(source, max_dimension, image_format, quality):
+    # Runs in the image process pool. source is a spool file path or raw bytes;
+    # returns (path or bytes, mime type) for a resized/re-encoded copy, or None
+    # if the original can be sent unchanged.
+    from PIL import Image, ImageOps
+
+    with Image.open(source if isinstance(source, str) else io.BytesIO(source)) as img:
+        if img.format in PROVIDER_IMAGE_FORMATS and max(img.size) <= max_dimension:
+            return None
+        if getattr(img, 'is_animated', False) and img.format in PROVIDER_IMAGE_FORMATS:
+            return None
+
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+
+        image_format = image_format.upper()
+        if image_format == 'JPEG':
+            if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+                img = img.convert('RGBA')
+                background = Image.new('RGB', img.size, (255, 255, 255))
+                background.paste(img, mask=img.getchannel('A'))
+                img = background
+            elif img.mode != 'RGB':
+                img = img.convert('RGB')
+        elif img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA')
+
+        output = io.BytesIO()
+        img.save(output, format=image_format, quality=quality)
+
+    mime_type = PROVIDER_IMAGE_FORMATS.get(image_format, f"image/{image_format.lower()}")
+    if isinstance(source, str):
+        # One copy per setting: agents answering the same email can prepare
+        # the same spool file at once, with different limits
+        path = f"{source}.{max_dimension}.{image_format.lower()}.{quality}"
+        with open(f"{path}.tmp", 'wb') as f:
+            f.write(output.getbuffer())
+        os.replace(f"{path}.tmp", path)
+        return path, mime_type
+    return output.getvalue(), mime_type
+
+def _get_image_pool(max_workers):
+    global _image_pool
+    if _image_pool is None:
+        # spawn rather than fork: the job queue runs in a thread, and forking a
+        # threaded process can deadlock the children
+        _image_pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+    return _image_pool
+
+async def prepare_image_attachment(attachment, max_dimension, image_format, quality, max_workers):
+    source = attachment.get('path') or attachment.get('content')
+    loop = asyncio.get_running_loop()
+    result = await loop.run_in_executor(
+        _get_image_pool(max_workers), prepare_image, source, max_dimension, image_format, quality
+    )
+    if result is None:
+        return attachment, None
+
+    prepared, mime_type = result
+    prepared_attachment = dict(attachment)
+    if isinstance(prepared, str):
+        prepared_attachment['path'] = prepared
+        prepared_attachment['size'] = os.path.getsize(prepared)
+    else:
+        prepared_attachment['content'] = prepared
+        prepared_attachment['size'] = len(prepared)
+    return prepared_attachment, mime_type
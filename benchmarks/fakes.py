@@ -0,0 +1,166 @@
+# Mentat Mail: https://andybromberg.com/mentat-mail
+# Copyright (C) 2025 Andy Bromberg andy@andybromberg.com
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import time
+import random
+import socket
+import asyncio
+import uvicorn
+
+# Local stand-ins for the LLM provider and SendGrid, served over real HTTP so
+# the app under test goes through litellm and httpx exactly as in production.
+
+async def _read_json(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            break
+    body = b''.join(chunks)
+    return json.loads(body) if body else {}
+
+async def _respond_json(send, status, payload):
+    body = json.dumps(payload).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode('ascii'))]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+class FakeLLM:
+    # OpenAI-compatible /v1/chat/completions. Streams output_tokens one per
+    # chunk, after first_token_ms and then at tokens_per_second, and answers
+    # a rate_limit_rate fraction of calls with a 429.
+    def __init__(self, first_token_ms=300, tokens_per_second=50, output_tokens=200, rate_limit_rate=0.0):
+        self.first_token_ms = first_token_ms
+        self.tokens_per_second = tokens_per_second
+        self.output_tokens = output_tokens
+        self.rate_limit_rate = rate_limit_rate
+        self.calls = 0
+        self.rate_limited = 0
+
+    def _usage(self, request):
+        prompt_chars = len(json.dumps(request.get('messages', [])))
+        prompt_tokens = prompt_chars // 4
+        return {'prompt_tokens': prompt_tokens, 'completion_tokens': self.output_tokens, 'total_tokens': prompt_tokens + self.output_tokens}
+
+    def _chunk(self, request, delta, finish_reason=None):
+        return {
+            'id': 'chatcmpl-bench',
+            'object': 'chat.completion.chunk',
+            'created': int(time.time()),
+            'model': request.get('model', 'bench-model'),
+            'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return
+        if not scope['path'].endswith('/chat/completions'):
+            return await _respond_json(send, 404, {'error': {'message': 'not found'}})
+        request = await _read_json(receive)
+        self.calls += 1
+        if random.random() < self.rate_limit_rate:
+            self.rate_limited += 1
+            return await _respond_json(send, 429, {'error': {'message': 'Rate limit reached', 'type': 'rate_limit_error'}})
+
+        await asyncio.sleep(self.first_token_ms / 1000)
+        interval = 1 / self.tokens_per_second if self.tokens_per_second else 0
+        words = [f"word{i} " for i in range(self.output_tokens)]
+
+        if not request.get('stream'):
+            await asyncio.sleep(interval * self.output_tokens)
+            return await _respond_json(send, 200, {
+                'id': 'chatcmpl-bench',
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': request.get('model', 'bench-model'),
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': ''.join(words)}, 'finish_reason': 'stop'}],
+                'usage': self._usage(request)
+            })
+
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache')]
+        })
+
+        async def event(payload):
+            await send({'type': 'http.response.body', 'body': f"data: {json.dumps(payload)}\n\n".encode('utf-8'), 'more_body': True})
+
+        await event(self._chunk(request, {'role': 'assistant', 'content': ''}))
+        for i, word in enumerate(words):
+            if i:
+                await asyncio.sleep(interval)
+            await event(self._chunk(request, {'content': word}))
+        await event(self._chunk(request, {}, 'stop'))
+        if (request.get('stream_options') or {}).get('include_usage'):
+            usage_chunk = self._chunk(request, {})
+            usage_chunk['choices'] = []
+            usage_chunk['usage'] = self._usage(request)
+            await event(usage_chunk)
+        await send({'type': 'http.response.body', 'body': b"data: [DONE]\n\n", 'more_body': False})
+
+class FakeSendGrid:
+    # Accepts /v3/mail/send after latency_ms and records when each reply
+    # arrived, keyed on its In-Reply-To header.
+    def __init__(self, latency_ms=50):
+        self.latency_ms = latency_ms
+        self.replies = {}
+        self.waiters = {}
+
+    def reset(self):
+        self.replies.clear()
+        self.waiters.clear()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return
+        if scope['path'] != '/v3/mail/send':
+            return await _respond_json(send, 404, {'errors': [{'message': 'not found'}]})
+        email_data = await _read_json(receive)
+        await asyncio.sleep(self.latency_ms / 1000)
+        in_reply_to = (email_data.get('headers') or {}).get('In-Reply-To')
+        self.replies[in_reply_to] = time.monotonic()
+        waiter = self.waiters.get(in_reply_to)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(self.replies[in_reply_to])
+        await send({'type': 'http.response.start', 'status': 202, 'headers': [(b'content-length', b'0')]})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    def wait_for(self, message_id):
+        loop = asyncio.get_running_loop()
+        waiter = self.waiters.setdefault(message_id, loop.create_future())
+        if message_id in self.replies and not waiter.done():
+            waiter.set_result(self.replies[message_id])
+        return waiter
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+async def serve(app, port):
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port, log_level='warning', lifespan='off'))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        if task.done():
+            task.result()
+        await asyncio.sleep(0.05)
+    return server, task
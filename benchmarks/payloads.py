@@ -0,0 +1,89 @@
+# Mentat Mail: https://andybromberg.com/mentat-mail
+# Copyright (C) 2025 Andy Bromberg andy@andybromberg.com
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import io
+import random
+from functools import lru_cache
+
+# Synthetic SendGrid Inbound Parse payloads. Each builder takes the email's
+# index and returns (form fields, files) for a multipart POST to /inbound.
+
+SENDER = 'Bench Sender <sender@bench.example>'
+AGENT = 'bench@agent.bench.example'
+
+PARAGRAPH = (
+    "Following up on the plan we discussed: the migration is scheduled for next Tuesday, "
+    "the rollback script is ready, and we still need sign-off on the staging numbers. "
+    "Can you sanity-check the latency figures and tell me whether the p99 regression looks real? "
+)
+
+def _fields(index, subject, text='', html=''):
+    return {
+        'from': SENDER,
+        'to': AGENT,
+        'cc': '',
+        'subject': f"{subject} #{index}",
+        'text': text,
+        'html': html,
+        'Message-ID': f"<bench-{index}-{random.getrandbits(48):x}@bench.example>",
+        'References': ''
+    }
+
+def plain(index):
+    return _fields(index, 'Plain text question', text=PARAGRAPH * 2), None
+
+def html_only(index):
+    html = (
+        "<html><body><div dir=\"ltr\"><p>" + PARAGRAPH + "</p><p><b>Numbers:</b></p><ul>"
+        + ''.join(f"<li>Region {i}: {random.randint(80, 400)}ms</li>" for i in range(20))
+        + "</ul><blockquote><p>" + PARAGRAPH + "</p></blockquote></div></body></html>"
+    )
+    return _fields(index, 'HTML only', html=html), None
+
+def long_thread(index, depth=40):
+    # A reply chain where every message re-quotes everything before it, well
+    # past the default THREAD_TOKEN_BUDGET
+    lines = [PARAGRAPH]
+    for level in range(1, depth + 1):
+        prefix = '> ' * level
+        lines.append('')
+        lines.append(f"{'> ' * (level - 1)}On Mon, Jan {level % 28 + 1}, 2025 at 9:{level % 60:02d} AM Person {level} <p{level}@bench.example> wrote:")
+        lines.extend(prefix + sentence for sentence in (PARAGRAPH * 8).split('. '))
+    return _fields(index, 'Re: Long thread', text='\n'.join(lines)), None
+
+@lru_cache(maxsize=None)
+def _image(width, height, number):
+    from PIL import Image
+
+    # Noise compresses about as badly as a photo does
+    img = Image.effect_noise((width, height), 48).convert('RGB')
+    out = io.BytesIO()
+    img.save(out, format='PNG')
+    return out.getvalue()
+
+def images(index, count=3):
+    files = {
+        f"attachment{i + 1}": (f"photo{i + 1}.png", _image(2400, 1600, i), 'image/png')
+        for i in range(count)
+    }
+    return _fields(index, 'What is in these photos?', text="What's in these photos?"), files
+
+SCENARIOS = {
+    'plain': plain,
+    'html': html_only,
+    'thread': long_thread,
+    'images': images
+}
@@ -0,0 +1,248 @@
+# Mentat Mail: https://andybromberg.com/mentat-mail
+# Copyright (C) 2025 Andy Bromberg andy@andybromberg.com
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import httpx
+from benchmarks.fakes import FakeLLM, FakeSendGrid, free_port, serve
+from benchmarks.payloads import SCENARIOS, SENDER
+
+# Replays synthetic inbound emails against the ASGI app at a fixed arrival
+# rate and measures, per scenario:
+#   ack   - time for /inbound to return (what SendGrid waits on)
+#   reply - time from the POST until the reply reaches the fake SendGrid
+# plus replies/second and the peak RSS of the app's process tree. Each
+# scenario gets a fresh app process and an empty queue.
+#
+#   python -m benchmarks.run --scenarios plain,images --rate 20 --count 200
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+def _process_tree(pid):
+    pids = [pid]
+    try:
+        for tid in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{tid}/children") as f:
+                for child in f.read().split():
+                    pids.extend(_process_tree(int(child)))
+    except OSError:
+        pass
+    return pids
+
+def peak_rss_bytes(pid):
+    # Sum of each process's high-water mark (VmHWM); Linux only
+    total = None
+    for process in _process_tree(pid):
+        try:
+            with open(f"/proc/{process}/status") as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        total = (total or 0) + int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+def app_env(args, workdir, llm_url, sendgrid_url):
+    env = dict(os.environ)
+    env.update({
+        'SENDGRID_API_KEY': 'bench',
+        'SENDGRID_API_URL': sendgrid_url,
+        'SENDGRID_MAX_CONCURRENCY': str(args.concurrency),
+        'OPENAI_API_KEY': 'bench',
+        'OPENAI_API_BASE': f"{llm_url}/v1",
+        'OPENAI_BASE_URL': f"{llm_url}/v1",
+        'SYSTEM_PROMPT': 'You are a benchmark agent.',
+        'DEFAULT_MODEL_SLUG': 'bench-model',
+        'DEFAULT_PROVIDER': 'openai',
+        'WHITELISTED_EMAILS': SENDER.split('<')[1].rstrip('>'),
+        'MODEL_ALIASES': json.dumps({'bench': {'model': 'openai/bench-model', 'name': 'Mentat Bench', 'provider': 'openai'}}),
+        'QUEUE_DB_PATH': os.path.join(workdir, 'queue.db'),
+        'QUEUE_SPOOL_DIR': os.path.join(workdir, 'spool'),
+        'QUEUE_CONCURRENCY': '{}',
+        'QUEUE_DEFAULT_CONCURRENCY': str(args.concurrency),
+        'QUEUE_WORKERS_ENABLED': '1',
+        'PROVIDER_LIMITS': json.dumps({'openai': {'concurrency': args.concurrency}}),
+        'RESPONSE_CACHE_PATH': '',
+        'THREAD_SUMMARY_MODEL': '',
+        'FAN_OUT_AGENTS': '0',
+        'FLASK_DEBUG': '0',
+        'LITELLM_LOCAL_MODEL_COST_MAP': 'True'
+    })
+    return env
+
+async def start_app(env, port, workers):
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, '-m', 'uvicorn', 'asgi:app',
+        '--app-dir', APP_DIR, '--host', '127.0.0.1', '--port', str(port),
+        '--workers', str(workers), '--log-level', 'warning',
+        cwd=APP_DIR, env=env
+    )
+    async with httpx.AsyncClient() as client:
+        for _ in range(600):
+            if process.returncode is not None:
+                raise RuntimeError(f"App exited during startup with code {process.returncode}")
+            try:
+                if (await client.get(f"http://127.0.0.1:{port}/ping")).status_code == 200:
+                    return process
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.1)
+    process.kill()
+    raise RuntimeError("App did not start within 60s")
+
+async def stop_app(process):
+    if process.returncode is None:
+        process.terminate()
+        try:
+            await asyncio.wait_for(process.wait(), timeout=30)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+
+async def run_scenario(name, args, llm, sendgrid, llm_url, sendgrid_url):
+    builder = SCENARIOS[name]
+    # Build payloads up front so generating them isn't on the clock
+    payloads = [builder(i) for i in range(args.count)]
+    workdir = tempfile.mkdtemp(prefix=f"mentat-bench-{name}-")
+    port = free_port()
+    llm.calls = llm.rate_limited = 0
+    sendgrid.reset()
+    process = await start_app(app_env(args, workdir, llm_url, sendgrid_url), port, args.workers)
+    loop = asyncio.get_running_loop()
+
+    async def send_one(client, index, fields, files, start):
+        await asyncio.sleep(max(0, start + index / args.rate - loop.time()))
+        reply = sendgrid.wait_for(fields['Message-ID'])
+        sent = time.monotonic()
+        try:
+            response = await client.post('/inbound', data=fields, files=files)
+        except httpx.HTTPError as e:
+            return {'error': type(e).__name__}
+        ack = time.monotonic() - sent
+        if response.status_code != 200:
+            return {'ack': ack, 'error': f"HTTP {response.status_code}"}
+        try:
+            replied = await asyncio.wait_for(reply, timeout=args.reply_timeout)
+        except asyncio.TimeoutError:
+            return {'ack': ack, 'error': 'no reply'}
+        return {'ack': ack, 'reply': replied - sent, 'sent': sent, 'replied': replied}
+
+    try:
+        limits = httpx.Limits(max_connections=max(100, int(args.rate * 4)))
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=60, limits=limits) as client:
+            start = loop.time()
+            results = await asyncio.gather(*[
+                send_one(client, index, fields, files, start)
+                for index, (fields, files) in enumerate(payloads)
+            ])
+        peak_rss = peak_rss_bytes(process.pid)
+    finally:
+        await stop_app(process)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    acks = [r['ack'] for r in results if 'ack' in r]
+    replies = [r for r in results if 'reply' in r]
+    errors = {}
+    for r in results:
+        if 'error' in r:
+            errors[r['error']] = errors.get(r['error'], 0) + 1
+    elapsed = (max(r['replied'] for r in replies) - min(r['sent'] for r in replies)) if replies else None
+    return {
+        'scenario': name,
+        'sent': len(results),
+        'replied': len(replies),
+        'errors': errors,
+        'ack_ms': {p: _ms(percentile(acks, p)) for p in (50, 95, 99)},
+        'reply_ms': {p: _ms(percentile([r['reply'] for r in replies], p)) for p in (50, 95, 99)},
+        'replies_per_second': round(len(replies) / elapsed, 2) if elapsed else None,
+        'peak_rss_mb': round(peak_rss / 1024 / 1024, 1) if peak_rss else None,
+        'llm_calls': llm.calls,
+        'llm_429s': llm.rate_limited
+    }
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+def _fmt(value):
+    return 'n/a' if value is None else f"{value:g}"
+
+def print_report(results):
+    print(f"\n{'scenario':<10} {'sent':>5} {'ok':>5} {'err':>5} {'ack p50/p95/p99 ms':>24} {'reply p50/p95/p99 ms':>26} {'replies/s':>10} {'peak RSS MB':>12}")
+    for r in results:
+        ack = '/'.join(_fmt(r['ack_ms'][p]) for p in (50, 95, 99))
+        reply = '/'.join(_fmt(r['reply_ms'][p]) for p in (50, 95, 99))
+        errors = sum(r['errors'].values())
+        print(f"{r['scenario']:<10} {r['sent']:>5} {r['replied']:>5} {errors:>5} {ack:>24} {reply:>26} {_fmt(r['replies_per_second']):>10} {_fmt(r['peak_rss_mb']):>12}")
+        if r['errors']:
+            print(f"{'':<10} errors: {r['errors']}")
+
+async def main(args):
+    llm = FakeLLM(args.llm_first_token_ms, args.llm_tokens_per_second, args.llm_output_tokens, args.llm_429_rate)
+    sendgrid = FakeSendGrid(args.sendgrid_latency_ms)
+    llm_port, sendgrid_port = free_port(), free_port()
+    servers = [await serve(llm, llm_port), await serve(sendgrid, sendgrid_port)]
+    results = []
+    try:
+        for name in args.scenarios.split(','):
+            name = name.strip()
+            if name not in SCENARIOS:
+                raise SystemExit(f"Unknown scenario {name!r}; choose from {', '.join(SCENARIOS)}")
+            print(f"Running {name}: {args.count} emails at {args.rate}/s")
+            results.append(await run_scenario(
+                name, args, llm, sendgrid, f"http://127.0.0.1:{llm_port}", f"http://127.0.0.1:{sendgrid_port}"
+            ))
+    finally:
+        for server, task in servers:
+            server.should_exit = True
+            await task
+
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2)
+    return results
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test /inbound against a fake LLM and a fake SendGrid")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help=f"comma-separated, from: {', '.join(SCENARIOS)}")
+    parser.add_argument('--rate', type=float, default=20, help="emails per second sent to /inbound")
+    parser.add_argument('--count', type=int, default=200, help="emails per scenario")
+    parser.add_argument('--workers', type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument('--concurrency', type=int, default=100, help="per-process queue and provider concurrency")
+    parser.add_argument('--llm-first-token-ms', type=float, default=300)
+    parser.add_argument('--llm-tokens-per-second', type=float, default=50)
+    parser.add_argument('--llm-output-tokens', type=int, default=200)
+    parser.add_argument('--llm-429-rate', type=float, default=0.0, help="fraction of LLM calls answered with a 429")
+    parser.add_argument('--sendgrid-latency-ms', type=float, default=50)
+    parser.add_argument('--reply-timeout', type=float, default=300, help="seconds to wait for each reply")
+    parser.add_argument('--json', help="also write results to this file")
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,157 @@
+# Mentat Mail: https://mentatmail.com
+# Copyright (C) 2025 Andy Bromberg andy@andybromberg.com
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import litellm
+from utils import debug_print
+from config import EmailProcessingError
+
+RESUME_INSTRUCTION = "Your previous reply was cut off. Continue it exactly where it stopped, without repeating anything you already wrote."
+# Longest first, so NOREPLY_LOOPING isn't mistaken for NOREPLY
+NOREPLY_SENTINELS = ('NOREPLY_LOOPING', 'NOREPLY')
+# Wrapping models sometimes put around the sentinel: quotes, markdown, brackets
+SENTINEL_WRAPPERS = ' \t\r\n"\'`*_[(<'
+
+class CompletionTimeout(EmailProcessingError):
+    def __init__(self, message, partial=''):
+        super().__init__(message, 504)
+        self.partial = partial
+
+def resume_messages(messages, partial):
+    # Hand the model what it already wrote so a retry continues instead of
+    # starting the whole answer over
+    if not partial:
+        return messages
+    return messages + [
+        {"role": "assistant", "content": partial},
+        {"role": "user", "content": RESUME_INSTRUCTION}
+    ]
+
+def match_noreply(text):
+    # The uppercase sentinel at the very start of the reply, followed by the
+    # end of the text or any non-word character ("NOREPLY - it's for Bob").
+    # "Noreply addresses are..." and "NOREPLYING" don't count.
+    normalized = text.lstrip(SENTINEL_WRAPPERS)
+    for sentinel in NOREPLY_SENTINELS:
+        if normalized.startswith(sentinel):
+            rest = normalized[len(sentinel):]
+            if not rest or not (rest[0].isalnum() or rest[0] == '_'):
+                return sentinel
+    return None
+
+def noreply_prefix_state(text):
+    # For a reply that is still streaming: 'match' once match_noreply would
+    # match whatever comes next, 'pending' while the text could still turn
+    # into a sentinel, 'no' once it can't
+    normalized = text.lstrip(SENTINEL_WRAPPERS)
+    # Includes exactly "NOREPLY", which could yet become NOREPLY_LOOPING or NOREPLYING
+    if any(s.startswith(normalized) for s in NOREPLY_SENTINELS):
+        return 'pending'
+    return 'match' if match_noreply(text) else 'no'
+
+def _cached_tokens(usage):
+    # Prompt tokens served from the provider's prefix cache. OpenAI-style
+    # usage reports them under prompt_tokens_details, Anthropic's as
+    # cache_read_input_tokens
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached = getattr(details, 'cached_tokens', None) if details is not None else None
+    return cached or getattr(usage, 'cache_read_input_tokens', None) or 0
+
+async def _close_stream(stream):
+    close = getattr(stream, 'aclose', None)
+    if close is None:
+        return
+    try:
+        await close()
+    except Exception:
+        pass
+
+async def stream_completion(model, messages, api_key, completion_params, first_token_timeout, total_timeout, stop_on_noreply=False):
+    # Returns (text, usage), usage being the provider's prompt, completion,
+    # total and prompt-cache token counts, or None if it sent none. Raises
+    # CompletionTimeout, carrying whatever was generated so far, if no token
+    # arrives within first_token_timeout or the whole answer takes longer than
+    # total_timeout. With stop_on_noreply, generation is cancelled as soon as
+    # the reply is known to be a NOREPLY sentinel, which is most turns in busy
+    # group threads.
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + total_timeout
+    parts = []
+    token_usage = None
+    stream = None
+
+    def remaining(first_token):
+        left = deadline - loop.time()
+        return min(left, first_token_timeout) if first_token else left
+
+    try:
+        stream = await asyncio.wait_for(
+            litellm.acompletion(
+                model=model,
+                messages=messages,
+                api_key=api_key,
+                stream=True,
+                stream_options={"include_usage": True},
+                drop_params=True,
+                **completion_params
+            ),
+            timeout=remaining(True)
+        )
+        iterator = stream.__aiter__()
+        while True:
+            try:
+                chunk = await asyncio.wait_for(iterator.__anext__(), timeout=max(0, remaining(not parts)))
+            except StopAsyncIteration:
+                break
+            usage = getattr(chunk, 'usage', None)
+            if usage is not None and getattr(usage, 'total_tokens', None):
+                token_usage = {
+                    'prompt_tokens': getattr(usage, 'prompt_tokens', None) or 0,
+                    'completion_tokens': getattr(usage, 'completion_tokens', None) or 0,
+                    'total_tokens': usage.total_tokens,
+                    'cached_tokens': _cached_tokens(usage),
+                    'cache_write_tokens': getattr(usage, 'cache_creation_input_tokens', None) or 0
+                }
+            if not chunk.choices:
+                continue
+            content = getattr(chunk.choices[0].delta, 'content', None)
+            if content:
+                parts.append(content)
+                if stop_on_noreply:
+                    state = noreply_prefix_state(''.join(parts))
+                    if state == 'match':
+                        debug_print(f"{model} replied with a NOREPLY sentinel, cancelling the rest of the generation")
+                        break
+                    if state == 'no':
+                        stop_on_noreply = False
+    except asyncio.TimeoutError:
+        phase = 'first token' if not parts else 'full response'
+        debug_print(f"{model} timed out waiting for {phase} after {len(parts)} chunks")
+        raise CompletionTimeout(f"AI API timeout: {model} took too long ({phase})", ''.join(parts))
+    except EmailProcessingError:
+        raise
+    except Exception as e:
+        # Keep the partial text around so the caller can resume from it
+        try:
+            e.partial = ''.join(parts)
+        except AttributeError:
+            pass
+        raise
+    finally:
+        if stream is not None:
+            await _close_stream(stream)
+
+    return ''.join(parts), token_usage
@@ -16,15 +16,46 @@
 
 import os
 import json
-from dotenv import load_dotenv
+import signal
+import threading
+from datetime import datetime
+from dotenv import find_dotenv, dotenv_values
+from utils import debug_print, compile_whitelist
+from prompts import SYSTEM_PROMPT_TEMPLATE, compile_prompt_template
+
+# Values that were already in the process environment win over .env, just like
+# load_dotenv() does, and keep winning when .env is reloaded.
+_startup_environ = frozenset(os.environ)
+_config = {}
+_config_lock = threading.Lock()
+_dotenv_path = None
+_dotenv_mtime = None
+_reload_requested = False
 
 class EmailProcessingError(Exception):
     def __init__(self, message, status_code):
         super().__init__(message)
         self.status_code = status_code
 
+def _apply_dotenv(path):
+    if not path:
+        return
+    for key, value in dotenv_values(path).items():
+        if key not in _startup_environ and value is not None:
+            os.environ[key] = value
+
+def _dotenv_mtime_for(path):
+    try:
+        return os.path.getmtime(path) if path else None
+    except OSError:
+        return None
+
 def load_configuration():
-    load_dotenv()
+    global _dotenv_path, _dotenv_mtime
+    if _dotenv_path is None:
+        _dotenv_path = find_dotenv()
+    _dotenv_mtime = _dotenv_mtime_for(_dotenv_path)
+    _apply_dotenv(_dotenv_path)
 
     required_env_vars = ['SENDGRID_API_KEY', 'SYSTEM_PROMPT', 'DEFAULT_MODEL_SLUG', 'WHITELISTED_EMAILS', 'DEFAULT_PROVIDER']
     missing_vars = [var for var in required_env_vars if not os.getenv(var)]
@@ -44,19 +75,115 @@ def load_configuration():
         model_aliases = {}
 
     model_mapping = {
-        'gpt4omini': {'model': 'openai/gpt-4o-mini', 'name': 'Mentat [GPT-4o Mini]', 'provider': 'openai'},
-        'gpt4o': {'model': 'openai/chatgpt-4o-latest', 'name': 'Mentat [GPT-4o]', 'provider': 'openai'},
-        'o1': {'model': 'openai/o1', 'name': 'Mentat [o1]', 'provider': 'openai'},
-        'o3mini': {'model': 'openai/o3-mini', 'name': 'Mentat [o3 Mini]', 'provider': 'openai'},
-        'claude': {'model': 'anthropic/claude-3-5-sonnet-latest', 'name': 'Mentat [Claude]', 'provider': 'anthropic'},
-        'geminiflash': {'model': 'gemini/gemini-2.0-flash', 'name': 'Mentat [Gemini 2.0 Flash]', 'provider': 'gemini'},
-        'geminipro': {'model': 'gemini/gemini-1.5-pro', 'name': 'Mentat [Gemini Pro]', 'provider': 'gemini'},
+        'gpt4omini': {'model': 'openai/gpt-4o-mini', 'name': 'Mentat [GPT-4o Mini]', 'provider': 'openai', 'max_image_dimension': 2048},
+        'gpt4o': {'model': 'openai/chatgpt-4o-latest', 'name': 'Mentat [GPT-4o]', 'provider': 'openai', 'max_image_dimension': 2048},
+        'o1': {'model': 'openai/o1', 'name': 'Mentat [o1]', 'provider': 'openai', 'max_image_dimension': 2048, 'first_token_timeout': 900, 'total_timeout': 1500, 'fallback': 'o3mini'},
+        'o3mini': {'model': 'openai/o3-mini', 'name': 'Mentat [o3 Mini]', 'provider': 'openai', 'first_token_timeout': 600, 'total_timeout': 900},
+        'claude': {'model': 'anthropic/claude-3-5-sonnet-latest', 'name': 'Mentat [Claude]', 'provider': 'anthropic', 'max_image_dimension': 1568},
+        'geminiflash': {'model': 'gemini/gemini-2.0-flash', 'name': 'Mentat [Gemini 2.0 Flash]', 'provider': 'gemini', 'max_image_dimension': 3072},
+        'geminipro': {'model': 'gemini/gemini-1.5-pro', 'name': 'Mentat [Gemini Pro]', 'provider': 'gemini', 'max_image_dimension': 3072},
         'sonarpro': {'model': 'perplexity/sonar-pro', 'name': 'Mentat [Sonar Pro]', 'provider': 'perplexity'}
     }
 
     model_mapping.update(model_aliases)
 
+    # Per-provider limits for LLM calls; a model entry above can also set
+    # 'concurrency', 'rpm' (requests/min) and 'tpm' (tokens/min) for itself
+    provider_limits = {
+        'openai': {'concurrency': 8},
+        'anthropic': {'concurrency': 8},
+        'gemini': {'concurrency': 8},
+        'perplexity': {'concurrency': 8}
+    }
+
+    try:
+        for provider, limits in json.loads(os.getenv('PROVIDER_LIMITS', '{}')).items():
+            provider_limits.setdefault(provider, {}).update(limits)
+    except (json.JSONDecodeError, AttributeError):
+        pass
+
+    try:
+        queue_concurrency = json.loads(os.getenv('QUEUE_CONCURRENCY', '{}'))
+    except json.JSONDecodeError:
+        queue_concurrency = {}
+
     return {
         'WHITELISTED_EMAILS': WHITELISTED_EMAILS,
-        'MODEL_MAPPING': model_mapping
-    } 
\ No newline at end of file
+        'WHITELIST': compile_whitelist(WHITELISTED_EMAILS),
+        'MODEL_MAPPING': model_mapping,
+        'PROVIDER_LIMITS': provider_limits,
+        'LOOP_MAX_AGENT_TURNS': int(os.getenv('LOOP_MAX_AGENT_TURNS', '10')),
+        'LOOP_MAX_FAST_TURNS': int(os.getenv('LOOP_MAX_FAST_TURNS', '5')),
+        'LOOP_MIN_TURN_SECONDS': float(os.getenv('LOOP_MIN_TURN_SECONDS', '30')),
+        'LOOP_MAX_AGENT_TOKENS': int(os.getenv('LOOP_MAX_AGENT_TOKENS', '200000')),
+        'LOOP_STATE_TTL_SECONDS': int(os.getenv('LOOP_STATE_TTL_SECONDS', str(7 * 24 * 3600))),
+        'FAN_OUT_AGENTS': os.getenv('FAN_OUT_AGENTS', '0') == '1',
+        'LLM_FIRST_TOKEN_TIMEOUT': float(os.getenv('LLM_FIRST_TOKEN_TIMEOUT', '120')),
+        'LLM_TOTAL_TIMEOUT': float(os.getenv('LLM_TOTAL_TIMEOUT', '600')),
+        'RATE_LIMIT_MAX_RETRIES': int(os.getenv('RATE_LIMIT_MAX_RETRIES', '5')),
+        'RESPONSE_CACHE_PATH': os.getenv('RESPONSE_CACHE_PATH', ''),
+        'RESPONSE_CACHE_MAX_BYTES': int(os.getenv('RESPONSE_CACHE_MAX_BYTES', str(50 * 1024 * 1024))),
+        'THREAD_TOKEN_BUDGET': int(os.getenv('THREAD_TOKEN_BUDGET', '16000')),
+        'THREAD_SUMMARY_TOKENS': int(os.getenv('THREAD_SUMMARY_TOKENS', '150')),
+        'THREAD_SUMMARY_MODEL': os.getenv('THREAD_SUMMARY_MODEL', ''),
+        'THREAD_SUMMARY_CACHE_SIZE': int(os.getenv('THREAD_SUMMARY_CACHE_SIZE', '2000')),
+        'SYSTEM_PROMPT_TEMPLATE': compile_prompt_template(SYSTEM_PROMPT_TEMPLATE, system_prompt=os.getenv('SYSTEM_PROMPT')),
+        'QUEUE_DB_PATH': os.getenv('QUEUE_DB_PATH', 'mentat_queue.db'),
+        'QUEUE_SPOOL_DIR': os.getenv('QUEUE_SPOOL_DIR', 'mentat_spool'),
+        'QUEUE_CONCURRENCY': queue_concurrency,
+        'QUEUE_DEFAULT_CONCURRENCY': int(os.getenv('QUEUE_DEFAULT_CONCURRENCY', '4')),
+        'QUEUE_MAX_ATTEMPTS': int(os.getenv('QUEUE_MAX_ATTEMPTS', '5')),
+        'QUEUE_LEASE_SECONDS': int(os.getenv('QUEUE_LEASE_SECONDS', '900')),
+        'QUEUE_POLL_SECONDS': float(os.getenv('QUEUE_POLL_SECONDS', '2')),
+        'QUEUE_WORKERS_ENABLED': os.getenv('QUEUE_WORKERS_ENABLED', '1') == '1',
+        'DEDUP_TTL_SECONDS': int(os.getenv('DEDUP_TTL_SECONDS', str(3 * 24 * 3600))),
+        'DEDUP_MAX_ENTRIES': int(os.getenv('DEDUP_MAX_ENTRIES', '10000')),
+        'MAX_MESSAGE_BYTES': int(os.getenv('MAX_MESSAGE_BYTES', str(30 * 1024 * 1024))),
+        'MAX_ATTACHMENT_BYTES': int(os.getenv('MAX_ATTACHMENT_BYTES', str(20 * 1024 * 1024))),
+        'MAX_FORM_FIELD_BYTES': int(os.getenv('MAX_FORM_FIELD_BYTES', str(5 * 1024 * 1024))),
+        'IMAGE_MAX_DIMENSION': int(os.getenv('IMAGE_MAX_DIMENSION', '2048')),
+        'IMAGE_FORMAT': os.getenv('IMAGE_FORMAT', 'jpeg'),
+        'IMAGE_QUALITY': int(os.getenv('IMAGE_QUALITY', '85')),
+        'IMAGE_WORKERS': int(os.getenv('IMAGE_WORKERS', '2')),
+        'ATTACHMENT_TOKEN_BUDGET': int(os.getenv('ATTACHMENT_TOKEN_BUDGET', '8000')),
+        'EXTRACT_WORKERS': int(os.getenv('EXTRACT_WORKERS', '2')),
+        'EXTRACT_TIMEOUT': float(os.getenv('EXTRACT_TIMEOUT', '30')),
+        'EXTRACT_CACHE_SIZE': int(os.getenv('EXTRACT_CACHE_SIZE', '200'))
+    }
+
+def get_configuration():
+    global _reload_requested
+    if _config and not _reload_requested and _dotenv_mtime_for(_dotenv_path) == _dotenv_mtime:
+        return _config
+
+    with _config_lock:
+        if not _config:
+            _config.update(load_configuration())
+        elif _reload_requested or _dotenv_mtime_for(_dotenv_path) != _dotenv_mtime:
+            _reload_requested = False
+            try:
+                new_config = load_configuration()
+            except RuntimeError as e:
+                debug_print(f"Keeping previous configuration, reload failed: {str(e)}")
+            else:
+                # Update in place so everything holding a reference sees the
+                # change. Other threads read it without the lock, so never
+                # empty it: overwrite, then drop keys that no longer exist.
+                _config.update(new_config)
+                for key in [key for key in _config if key not in new_config]:
+                    del _config[key]
+                debug_print(f"Configuration reloaded at {datetime.now().isoformat()}")
+    return _config
+
+def _request_reload(signum, frame):
+    global _reload_requested
+    _reload_requested = True
+
+def install_reload_signal():
+    if not hasattr(signal, 'SIGHUP'):
+        return
+    try:
+        signal.signal(signal.SIGHUP, _request_reload)
+    except ValueError:
+        # Only the main thread can install signal handlers
+        pass
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The modules live at the repo root rather than in a package, so make them
+# importable however pytest is started (pytest or python -m pytest)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# litellm otherwise fetches its model cost map over the network on import
+os.environ.setdefault('LITELLM_LOCAL_MODEL_COST_MAP', 'True')
@@ -0,0 +1,94 @@
+# Mentat Mail: https://mentatmail.com
+# Copyright (C) 2025 Andy Bromberg andy@andybromberg.com
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import random
+import sqlite3
+from utils import debug_print
+
+# SendGrid re-delivers inbound webhooks on timeouts and 5xx. We remember every
+# (Message-ID, agent address) pair we've accepted in the queue database; the
+# primary key makes the claim atomic, so when two deliveries of the same message
+# race, exactly one of them wins and gets processed.
+
+def _connect(config):
+    return sqlite3.connect(config['QUEUE_DB_PATH'], timeout=30, isolation_level=None)
+
+def init_dedup(config):
+    conn = _connect(config)
+    try:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS seen_messages (
+                message_id TEXT NOT NULL,
+                agent_address TEXT NOT NULL,
+                seen_at REAL NOT NULL,
+                PRIMARY KEY (message_id, agent_address)
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS seen_messages_age ON seen_messages (seen_at)")
+    finally:
+        conn.close()
+
+def claim_message(config, message_id, agent_address):
+    if not message_id:
+        return True
+
+    now = time.time()
+    key = (message_id.strip(), (agent_address or '').lower())
+    conn = _connect(config)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(
+            "DELETE FROM seen_messages WHERE message_id = ? AND agent_address = ? AND seen_at < ?",
+            key + (now - config['DEDUP_TTL_SECONDS'],)
+        )
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO seen_messages (message_id, agent_address, seen_at) VALUES (?, ?, ?)",
+            key + (now,)
+        )
+        claimed = cursor.rowcount == 1
+        if claimed and random.random() < 0.01:
+            _evict(conn, config, now)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+    if not claimed:
+        debug_print(f"Duplicate delivery of {key[0]} for {key[1]} - skipping")
+    return claimed
+
+def release_message(config, message_id, agent_address):
+    if not message_id:
+        return
+    conn = _connect(config)
+    try:
+        conn.execute(
+            "DELETE FROM seen_messages WHERE message_id = ? AND agent_address = ?",
+            (message_id.strip(), (agent_address or '').lower())
+        )
+    finally:
+        conn.close()
+
+def _evict(conn, config, now):
+    conn.execute("DELETE FROM seen_messages WHERE seen_at < ?", (now - config['DEDUP_TTL_SECONDS'],))
+    conn.execute("""
+        DELETE FROM seen_messages WHERE seen_at <= (
+            SELECT seen_at FROM seen_messages ORDER BY seen_at DESC LIMIT 1 OFFSET ?
+        )
+    """, (config['DEDUP_MAX_ENTRIES'],))
@@ -0,0 +1,93 @@
+# Mentat Mail: https://mentatmail.com
+# Copyright (C) 2025 Andy Bromberg andy@andybromberg.com
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import random
+import asyncio
+import httpx
+from utils import debug_print
+from config import EmailProcessingError
+
+# One pooled client per event loop: httpx connections can't be shared across
+# loops, and the job queue runs a single long-lived loop per process, so in
+# practice this is one client with warm keep-alive connections to SendGrid.
+
+_clients = {}
+_transport = None
+
+def set_transport(transport):
+    # Lets tests and benchmarks point delivery at a fake SendGrid, e.g.
+    # httpx.MockTransport(handler). Pass None to go back to the network.
+    global _transport
+    _transport = transport
+    _clients.clear()
+
+def _get_client():
+    loop = asyncio.get_running_loop()
+    entry = _clients.get(loop)
+    if entry is None:
+        for stale_loop in [l for l in _clients if l.is_closed()]:
+            del _clients[stale_loop]
+        max_concurrency = int(os.getenv('SENDGRID_MAX_CONCURRENCY', '10'))
+        client = httpx.AsyncClient(
+            base_url=os.getenv('SENDGRID_API_URL', 'https://api.sendgrid.com'),
+            timeout=float(os.getenv('SENDGRID_TIMEOUT_SECONDS', '30')),
+            limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency),
+            transport=_transport
+        )
+        entry = (client, asyncio.Semaphore(max_concurrency))
+        _clients[loop] = entry
+    return entry
+
+async def close_clients():
+    loop = asyncio.get_running_loop()
+    entry = _clients.pop(loop, None)
+    if entry is not None:
+        await entry[0].aclose()
+
+def _retry_delay(attempt, response=None):
+    if response is not None:
+        retry_after = response.headers.get('Retry-After')
+        if retry_after and retry_after.isdigit():
+            return min(60, int(retry_after))
+    return min(30, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+async def send_mail(email_data):
+    client, semaphore = _get_client()
+    max_attempts = int(os.getenv('SENDGRID_MAX_ATTEMPTS', '4'))
+    headers = {'Authorization': f"Bearer {os.getenv('SENDGRID_API_KEY')}"}
+
+    for attempt in range(max_attempts):
+        response = None
+        try:
+            async with semaphore:
+                response = await client.post('/v3/mail/send', json=email_data, headers=headers)
+        except httpx.TransportError as e:
+            error = f"{type(e).__name__}: {str(e)}"
+        else:
+            if response.status_code < 300:
+                return response
+            error = f"HTTP {response.status_code}: {response.text}"
+            if response.status_code != 429 and response.status_code < 500:
+                debug_print(f"SendGrid rejected the email: {error}")
+                raise EmailProcessingError(f"Failed to send email: {error}", response.status_code)
+
+        if attempt + 1 < max_attempts:
+            delay = _retry_delay(attempt, response)
+            debug_print(f"SendGrid send failed ({error}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    raise EmailProcessingError(f"Failed to send email: {error}", 500)
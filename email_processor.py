@@ -15,23 +15,71 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>. 
 
 import os
-import base64
+import random
+import asyncio
 from datetime import datetime
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail, Email, To, Content, PlainTextContent
 import litellm
-from utils import debug_print, extract_email, is_email_whitelisted, format_quoted_text
-from config import EmailProcessingError, load_configuration
+import delivery
+import rate_limits
+import response_cache
+import loop_breaker
+import metrics
+from completions import stream_completion, resume_messages, match_noreply, CompletionTimeout
+from threads import compact_thread, thread_root
+from attachments import encode_data_url, attachment_size, prepare_image_attachment
+from extractors import find_extractor, extract_attachments
+from utils import debug_print, is_email_whitelisted, format_quoted_text, estimate_tokens
+from config import EmailProcessingError, get_configuration
+from prompts import render_prompt_parts, system_message
+from recipients import Recipients
 
-async def process_attachments(attachments):
-    message_content = []
+def shared_task(shared, key, make_coroutine):
+    # When several agents answer the same email, the first one to need a
+    # piece of preparation (thread compaction, an encoded image) starts it and
+    # the rest await the same result
+    if shared is None:
+        return make_coroutine()
+    if key not in shared:
+        shared[key] = asyncio.ensure_future(make_coroutine())
+    return shared[key]
+
+async def process_image_attachment(attachment, mime_type, model_info, config):
+    max_dimension = model_info.get('max_image_dimension', config['IMAGE_MAX_DIMENSION'])
+    try:
+        attachment, prepared_mime_type = await prepare_image_attachment(
+            attachment,
+            max_dimension,
+            model_info.get('image_format', config['IMAGE_FORMAT']),
+            model_info.get('image_quality', config['IMAGE_QUALITY']),
+            config['IMAGE_WORKERS']
+        )
+        if prepared_mime_type:
+            debug_print(f"Re-encoded {attachment['filename']} as {prepared_mime_type} (max {max_dimension}px, {attachment_size(attachment)} bytes)")
+            mime_type = prepared_mime_type
+    except Exception as e:
+        debug_print(f"Could not preprocess image {attachment['filename']}, sending original: {str(e)}")
+
+    # Off the event loop, which under asgi.py is also serving webhooks
+    url = await asyncio.to_thread(encode_data_url, attachment, mime_type)
+    return {
+        "type": "image_url",
+        "image_url": {
+            "url": url
+        }
+    }
+
+async def process_attachments(attachments, model_info, config, shared=None):
+    image_tasks = []
+    documents = []
     text_content = ""
     
     for attachment in attachments:
         try:
             debug_print(f"\nProcessing attachment: {attachment['filename']}")
-            debug_print(f"Content type: {type(attachment['content'])}")
-            debug_print(f"Content length: {len(attachment['content'])}")
+            debug_print(f"Content length: {attachment_size(attachment)}")
+            if attachment.get('oversized'):
+                text_content += f"\n[Attached file: {attachment['filename']} (too large, not included)]"
+                continue
             file_ext = os.path.splitext(attachment['filename'].lower())[1]
             image_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tiff', '.tif'}
             content_type = attachment.get('content_type')
@@ -42,7 +90,6 @@ async def process_attachments(attachments):
             )
             
             if is_image:
-                image_content = base64.b64encode(attachment['content']).decode('utf-8')
                 mime_type = 'png'
                 if content_type and content_type.startswith('image/'):
                     mime_type = content_type.split('/')[1]
@@ -51,12 +98,12 @@ async def process_attachments(attachments):
                 elif file_ext in {'.gif', '.webp', '.bmp', '.tiff', '.tif', '.png'}:
                     mime_type = file_ext[1:]
                 
-                message_content.append({
-                    "type": "image_url",
-                    "image_url": {
-                        "url": f"data:image/{mime_type};base64,{image_content}"
-                    }
-                })
+                image_tasks.append(shared_task(
+                    shared, ('image', id(attachment), model_info.get('max_image_dimension'), model_info.get('image_format'), model_info.get('image_quality')),
+                    lambda attachment=attachment, mime_type=mime_type: process_image_attachment(attachment, f"image/{mime_type}", model_info, config)
+                ))
+            elif find_extractor(attachment['filename'], content_type):
+                documents.append(attachment)
             else:
                 text_content += f"\n[Attached file: {attachment['filename']} (not an image)]"
                 
@@ -64,40 +111,72 @@ async def process_attachments(attachments):
             debug_print(f"Error processing attachment {attachment['filename']}: {str(e)}")
             import traceback
             debug_print(traceback.format_exc())
+    
+    if documents:
+        token_budget = model_info.get('attachment_token_budget', config['ATTACHMENT_TOKEN_BUDGET'])
+        text_content += await shared_task(
+            shared, ('documents', token_budget),
+            lambda: extract_attachments(documents, token_budget, config)
+        )
+
+    message_content = []
+    for result in await asyncio.gather(*image_tasks, return_exceptions=True):
+        if isinstance(result, Exception):
+            debug_print(f"Error processing image attachment: {str(result)}")
+        else:
+            message_content.append(result)
             
     return message_content, text_content
 
-async def get_ai_response(text_content, attachments, clean_to_email, subject, model_mapping):
-    debug_print("\n=== Preparing AI Request ===")
-    system_prompt = f"""You are an AI assistant participating in an email thread. The message you receive will contain the full email thread, with the most recent message at the top. Email threads are typically marked with ">" characters at the start of quoted lines, with more ">" characters indicating older messages.
+COMPLETION_PARAMS = ('temperature', 'top_p', 'max_tokens', 'seed')
 
-IMPORTANT:
-1. Only respond to the most recent message (the text at the top before any ">" marks)
-2. Use the quoted/older messages (typically marked with ">") only for context to understand what was previously discussed and to inform your response to the most recent message. Read carefully and make sure you're paying attention to the logical sequence of the messages (most recent at the top).
-3. If you're HIGHLY confident there is anything for you to respond to in the most recent message, reply with "NOREPLY" — for example: if there are multiple people on the thread and the most recent message is clearly addressed to someone else and not you, simply say "NOREPLY" - however, err on the side of responding normally; only use NOREPLY if you're confident there's nothing to reply to. Most of the time, when you're on a thread and a question is posed, it is meant for you, so do not use NOREPLY.
-4. When responding in a group thread:
-   - Pay attention to who the message is addressed to (look for "@name" or direct addressing)
-   - Only respond if you're directly addressed or if the question/discussion is relevant to your role
-   - Be mindful not to interrupt conversations between other participants
+# Providers that only cache a prompt prefix when it's marked with cache_control.
+# OpenAI, Gemini and the rest cache matching prefixes on their own.
+PROMPT_CACHE_PROVIDERS = ('anthropic',)
 
-Additional context:
-- The subject of the email is: {subject}
-- Your email address is {clean_to_email}. As you're reviewing the thread, you may see prior messages from yourself.
-- You might be addressed by the names "Mentat" or "{clean_to_email.split('@')[0]}" or something similar
-- The current date is {datetime.now().strftime("%Y-%m-%d")}.
+def get_completion_params(model_info):
+    return {key: model_info[key] for key in COMPLETION_PARAMS if key in model_info}
 
-There is a possibility of a situation where you and another AI agent go back and forth endlessly in an unproductive way. If you think this might be happening, you should reply once saying that you're wondering if that's what is happening and ask a human if you should keep responding. After that, reply "NOREPLY_LOOPING" unless a human affirms you should continue. If you really think it's happening or a looping conversation is continuing, simply reply "NOREPLY_LOOPING"
+def use_prompt_cache(model_info):
+    return bool(model_info.get('prompt_cache', model_info.get('provider') in PROMPT_CACHE_PROVIDERS))
 
-Aside from those specific and IMPORTANT instructions, here are general instructions for how you should reply:
+def get_model_info(clean_to_email, model_mapping):
+    from_email_name = clean_to_email.split('@')[0].lower()
+    debug_print(f"Looking up model for email name: {from_email_name}")
+    
+    model_info = model_mapping.get(from_email_name, {
+        'model': f"{os.getenv('DEFAULT_PROVIDER')}/{os.getenv('DEFAULT_MODEL_SLUG')}",
+        'provider': os.getenv('DEFAULT_PROVIDER')
+    })
+    debug_print(f"Selected model info: {model_info}")
+    return model_info
 
-{os.getenv('SYSTEM_PROMPT')}"""
+async def get_ai_response(text_content, attachments, clean_to_email, subject, config, thread_id=None, shared=None, partial_responses=None, stats=None):
+    debug_print("\n=== Preparing AI Request ===")
+    model_info = get_model_info(clean_to_email, config['MODEL_MAPPING'])
+    prompt_prefix, prompt_suffix = render_prompt_parts(
+        config['SYSTEM_PROMPT_TEMPLATE'],
+        subject=subject,
+        agent_email=clean_to_email,
+        agent_name=clean_to_email.split('@')[0],
+        current_date=datetime.now().strftime("%Y-%m-%d")
+    )
 
-    messages = [{"role": "system", "content": system_prompt}]
+    messages = [system_message(prompt_prefix, prompt_suffix, use_prompt_cache(model_info))]
     debug_print(f"System prompt prepared")
 
+    timings = stats.setdefault('timings', {}) if stats is not None else None
+    token_budget = model_info.get('thread_token_budget', config['THREAD_TOKEN_BUDGET'])
+    with metrics.timed('thread_compaction', timings):
+        text_content = await shared_task(
+            shared, ('thread', token_budget),
+            lambda: compact_thread(text_content, thread_id, token_budget, config)
+        )
+
     if attachments:
         message_content = [{"type": "text", "text": text_content}]
-        attachment_content, attachment_text = await process_attachments(attachments)
+        with metrics.timed('attachments', timings):
+            attachment_content, attachment_text = await process_attachments(attachments, model_info, config, shared)
         message_content.extend(attachment_content)
         if attachment_text:
             message_content[0]["text"] += attachment_text
@@ -106,16 +185,21 @@ Aside from those specific and IMPORTANT instructions, here are general instructi
     else:
         messages.append({"role": "user", "content": text_content})
         debug_print(f"Added text message: {text_content}")
-
-    from_email_name = clean_to_email.split('@')[0].lower()
-    debug_print(f"Looking up model for email name: {from_email_name}")
-    
-    model_info = model_mapping.get(from_email_name, {
-        'model': f"{os.getenv('DEFAULT_PROVIDER')}/{os.getenv('DEFAULT_MODEL_SLUG')}",
-        'provider': os.getenv('DEFAULT_PROVIDER')
-    })
-    debug_print(f"Selected model info: {model_info}")
     
+    try:
+        return await call_model(model_info, messages, config, partial_responses, stop_on_noreply=True, stats=stats)
+    except CompletionTimeout as e:
+        fallback_info = config['MODEL_MAPPING'].get((model_info.get('fallback') or '').lower())
+        if not fallback_info:
+            raise
+        debug_print(f"{model_info.get('model')} timed out, falling back to {fallback_info.get('model')}")
+        messages = [system_message(prompt_prefix, prompt_suffix, use_prompt_cache(fallback_info))] + messages[1:]
+        ai_response = await call_model(fallback_info, messages, config, partial_responses, stop_on_noreply=True, stats=stats)
+        model_name = model_info.get('name', model_info.get('model'))
+        fallback_name = fallback_info.get('name', fallback_info.get('model'))
+        return f"{ai_response.rstrip()}\n\n[Note: {model_name} didn't answer in time, so this reply is from {fallback_name}.]"
+
+async def call_model(model_info, messages, config, partial_responses=None, stop_on_noreply=False, stats=None):
     provider = model_info.get('provider')
     debug_print(f"Using provider: {provider}")
     
@@ -124,42 +208,86 @@ Aside from those specific and IMPORTANT instructions, here are general instructi
         debug_print(f"No API key found for provider {provider}")
         raise EmailProcessingError(f"No API key found for provider {provider}", 500)
     
-    debug_print(f"Making API call to model: {model_info.get('model')}")
-    try:
-        response = await litellm.acompletion(
-            model=model_info.get('model'),
-            messages=messages,
-            api_key=api_key
-        )
-        debug_print("API call successful")
-        debug_print(f"\n=== LLM Response ===\n{response.choices[0].message.content}\n==================")
-        return response.choices[0].message.content
-    except Exception as e:
-        debug_print(f"Error in AI API call: {str(e)}")
-        raise EmailProcessingError(f"AI API error: {str(e)}", 500)
-
-async def send_email_response(ai_response, text_content, from_email, to_email, subject, message_id, references, model_name, clean_to_email, cc_addresses=''):
-    sg = SendGridAPIClient(os.getenv('SENDGRID_API_KEY'))
+    completion_params = get_completion_params(model_info)
+    cache_key = None
+    if model_info.get('cache'):
+        cache_key = response_cache.make_key(model_info.get('model'), completion_params, messages)
+        cached_response = await response_cache.get(config, cache_key)
+        if cached_response is not None:
+            metrics.inc('mentat_llm_calls_total', model=model_info.get('model'), outcome='cache_hit')
+            return cached_response
+    
+    model = model_info.get('model')
+    timings = stats.setdefault('timings', {}) if stats is not None else None
+    if partial_responses is None:
+        partial_responses = {}
+    first_token_timeout = model_info.get('first_token_timeout', config['LLM_FIRST_TOKEN_TIMEOUT'])
+    total_timeout = model_info.get('total_timeout', config['LLM_TOTAL_TIMEOUT'])
     
+    debug_print(f"Making API call to model: {model}")
+    estimated_tokens = rate_limits.estimate_message_tokens(messages)
+    max_retries = config['RATE_LIMIT_MAX_RETRIES']
+    for attempt in range(max_retries + 1):
+        partial = partial_responses.get(model, '')
+        if partial:
+            debug_print(f"Resuming {model} from {len(partial)} characters of earlier output")
+        try:
+            async with rate_limits.limit(model_info, config['PROVIDER_LIMITS'], estimated_tokens) as usage:
+                with metrics.timed('llm', timings, model=model):
+                    continuation, token_usage = await stream_completion(
+                        model, resume_messages(messages, partial), api_key, completion_params,
+                        first_token_timeout, total_timeout, stop_on_noreply=stop_on_noreply and not partial
+                    )
+                total_tokens = token_usage['total_tokens'] if token_usage else None
+                usage.record(total_tokens)
+            metrics.inc('mentat_llm_calls_total', model=model, outcome='ok')
+            if token_usage:
+                metrics.inc('mentat_llm_tokens_total', token_usage['prompt_tokens'], model=model, kind='prompt')
+                metrics.inc('mentat_llm_tokens_total', token_usage['completion_tokens'], model=model, kind='completion')
+                metrics.inc('mentat_llm_tokens_total', token_usage['cached_tokens'], model=model, kind='cache_read')
+                metrics.inc('mentat_llm_tokens_total', token_usage['cache_write_tokens'], model=model, kind='cache_write')
+                metrics.inc('mentat_prompt_cache_total', model=model, result='hit' if token_usage['cached_tokens'] else 'miss')
+            if stats is not None:
+                stats['tokens'] = stats.get('tokens', 0) + (total_tokens or estimated_tokens + estimate_tokens(continuation))
+            ai_response = partial + continuation
+            partial_responses.pop(model, None)
+            debug_print("API call successful")
+            debug_print(f"\n=== LLM Response ===\n{ai_response}\n==================")
+            if cache_key:
+                await response_cache.put(config, cache_key, ai_response)
+            return ai_response
+        except CompletionTimeout as e:
+            metrics.inc('mentat_llm_calls_total', model=model, outcome='timeout')
+            partial_responses[model] = partial + e.partial
+            raise
+        except litellm.RateLimitError as e:
+            metrics.inc('mentat_llm_calls_total', model=model, outcome='rate_limited')
+            partial_responses[model] = partial + getattr(e, 'partial', '')
+            if attempt >= max_retries:
+                debug_print(f"Still rate limited after {max_retries} retries: {str(e)}")
+                raise EmailProcessingError(f"AI API error: {str(e)}", 500)
+            delay = min(60, 2 ** attempt) * random.uniform(0.5, 1.5)
+            debug_print(f"Rate limited by {provider}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+        except EmailProcessingError:
+            raise
+        except Exception as e:
+            metrics.inc('mentat_llm_calls_total', model=model, outcome='error')
+            partial_responses[model] = partial + getattr(e, 'partial', '')
+            debug_print(f"Error in AI API call: {str(e)}")
+            raise EmailProcessingError(f"AI API error: {str(e)}", 500)
+
+async def send_email_response(ai_response, text_content, from_email, to_email, subject, message_id, references, model_name, clean_to_email, cc_addresses='', recipients=None):
     clean_subject = subject.strip() if subject else ""
     reply_subject = f"Re: {clean_subject}" if not clean_subject.startswith('Re: ') else clean_subject
     
-    sending_to_email = extract_email(from_email)
     clean_response = ai_response.strip()
     quoted_text = format_quoted_text(text_content, from_email)
     full_response = clean_response + quoted_text
     
-    to_emails = [extract_email(email) for email in to_email.split(',') 
-                 if email.strip() and extract_email(email).lower() != clean_to_email.lower()]
-    if isinstance(cc_addresses, str):
-        cc_emails = [extract_email(addr.strip()) for addr in cc_addresses.split(',') 
-                    if addr.strip() and extract_email(addr).lower() != clean_to_email.lower()]
-    else:
-        cc_emails = [extract_email(addr) for addr in cc_addresses 
-                    if addr.strip() and extract_email(addr).lower() != clean_to_email.lower()]
-    
-    if extract_email(from_email).lower() != clean_to_email.lower() and extract_email(from_email) not in to_emails:
-        to_emails = [extract_email(from_email)] + to_emails
+    if recipients is None:
+        recipients = Recipients.parse(from_email, to_email, cc_addresses)
+    to_emails, cc_emails = recipients.reply_addresses(clean_to_email)
     
     if not to_emails:
         raise EmailProcessingError("No valid recipient email addresses", 400)
@@ -195,75 +323,150 @@ async def send_email_response(ai_response, text_content, from_email, to_email, s
     if not email_data["personalizations"][0].get("cc"):
         del email_data["personalizations"][0]["cc"]
     
-    try:
-        response = sg.client.mail.send.post(request_body=email_data)
-        debug_print(f"Email response sent successfully with status code: {response.status_code}")
-        return True, "Email processed and response sent successfully", 200
-    except Exception as e:
-        debug_print(f"\n=== SendGrid Error ===")
-        if hasattr(e, 'body'):
-            debug_print(f"Error Response: {e.body}")
-        raise EmailProcessingError(f"Failed to send email: {str(e)}", 500)
+    response = await delivery.send_mail(email_data)
+    debug_print(f"Email response sent successfully with status code: {response.status_code}")
+    return True, "Email processed and response sent successfully", 200
+
+def get_agent_address(to_email, cc_addresses, model_mapping):
+    agent_addresses = Recipients.parse('', to_email, cc_addresses).agent_addresses(model_mapping)
+    return agent_addresses[0] if agent_addresses else None
+
+def get_provider_for_email(agent_address, model_mapping):
+    if not agent_address:
+        return os.getenv('DEFAULT_PROVIDER')
+    model_info = model_mapping.get(agent_address.split('@')[0].lower(), {})
+    return model_info.get('provider', os.getenv('DEFAULT_PROVIDER'))
+
+async def reply_as_agent(config, clean_to_email, from_email, to_email, subject, text_content, message_id, references, attachments, cc_addresses, shared=None, partial_responses=None, stats=None, recipients=None):
+    model_data = config['MODEL_MAPPING'].get(clean_to_email.split('@')[0].lower(), {
+        'model': os.getenv('DEFAULT_MODEL_SLUG'),
+        'name': f"Mentat [{os.getenv('DEFAULT_MODEL_SLUG')}]"
+    })
+    
+    agent_partials = None
+    if partial_responses is not None:
+        agent_partials = partial_responses.setdefault(clean_to_email.lower(), {})
+    ai_response = await get_ai_response(
+        text_content, attachments, clean_to_email, subject, config,
+        thread_root(references, message_id), shared, agent_partials, stats
+    )
+    
+    sentinel = match_noreply(ai_response)
+    if sentinel == "NOREPLY_LOOPING":
+        debug_print(f"{clean_to_email}: AI indicated looping conversation - stopping processing")
+        return True, "AI indicated looping conversation - stopping processing", 200
+    if sentinel == "NOREPLY":
+        debug_print(f"{clean_to_email}: AI indicated no reply needed - stopping processing")
+        return True, "AI determined no reply was needed", 200
+    
+    with metrics.timed('send', stats.setdefault('timings', {}) if stats is not None else None):
+        return await send_email_response(
+            ai_response=ai_response,
+            text_content=text_content,
+            from_email=from_email,
+            to_email=to_email,
+            subject=subject,
+            message_id=message_id,
+            references=references,
+            model_name=model_data['name'],
+            clean_to_email=clean_to_email,
+            cc_addresses=cc_addresses,
+            recipients=recipients
+        )
 
-async def process_and_reply_to_email(from_email, to_email, subject, text_content, message_id=None, references=None, attachments=None, cc_addresses=''):
+async def process_and_reply_to_email(from_email, to_email, subject, text_content, message_id=None, references=None, attachments=None, cc_addresses='', replied_agents=None, partial_responses=None):
+    stats = {'timings': {}}
+    with metrics.timed('total', stats['timings']):
+        success, message, status_code = await _process_and_reply(
+            from_email, to_email, subject, text_content, message_id, references,
+            attachments, cc_addresses, replied_agents, partial_responses, stats
+        )
+    if success:
+        outcome = 'ok'
+    elif status_code < 500:
+        outcome = 'rejected'
+    else:
+        outcome = 'error'
+    metrics.inc('mentat_emails_total', outcome=outcome)
+    metrics.log_timings(stats['timings'], message_id=message_id, status=status_code, tokens=stats.get('tokens'))
+    return success, message, status_code
+
+async def _process_and_reply(from_email, to_email, subject, text_content, message_id, references, attachments, cc_addresses, replied_agents, partial_responses, stats):
+    timings = stats['timings']
     try:
-        sender_email = extract_email(from_email).lower()
-        config = load_configuration()
-        
-        if not is_email_whitelisted(sender_email, config['WHITELISTED_EMAILS']):
+        config = get_configuration()
+        recipients = Recipients.parse(from_email, to_email, cc_addresses)
+        with metrics.timed('whitelist', timings):
+            sender_email = recipients.sender.lower()
+            whitelisted = is_email_whitelisted(sender_email, config['WHITELIST'])
+        if not whitelisted:
             debug_print(f"Rejected email from non-whitelisted sender: {sender_email}")
             raise EmailProcessingError("Sender email not whitelisted", 403)
         
-        to_addresses = [extract_email(addr.strip()) for addr in to_email.split(',') if addr.strip()]
-        if isinstance(cc_addresses, str):
-            cc_list = [extract_email(addr.strip()) for addr in cc_addresses.split(',') if addr.strip()]
-        else:
-            cc_list = [extract_email(addr) for addr in cc_addresses if addr.strip()]
-        
-        all_addresses = to_addresses + cc_list
-        agent_addresses = [addr for addr in all_addresses if addr.split('@')[0].lower() in config['MODEL_MAPPING']]
-        
+        with metrics.timed('agent_resolution', timings):
+            agent_addresses = recipients.agent_addresses(config['MODEL_MAPPING'])
         if not agent_addresses:
-            clean_to_email = all_addresses[0]
-            from_email_name = clean_to_email.split('@')[0]
-        else:
-            clean_to_email = agent_addresses[0]
-            from_email_name = clean_to_email.split('@')[0]
+            raise EmailProcessingError("No recipient addresses found", 400)
+        
+        thread_id = thread_root(references, message_id)
+        agent_authored = loop_breaker.is_agent_sender(sender_email, agent_addresses)
+        with metrics.timed('loop_check', timings):
+            loop_reason = await asyncio.to_thread(loop_breaker.check_thread, config, thread_id, message_id, agent_authored)
+        if loop_reason:
+            return True, f"Agent loop circuit breaker tripped ({loop_reason}) - stopping processing", 200
         
-        model_data = config['MODEL_MAPPING'].get(from_email_name.lower(), {
-            'model': os.getenv('DEFAULT_MODEL_SLUG'),
-            'name': f"Mentat [{os.getenv('DEFAULT_MODEL_SLUG')}]"
-        })
+        if not config['FAN_OUT_AGENTS']:
+            agent_addresses = agent_addresses[:1]
+        # On a retry, skip agents that already replied the first time around
+        if replied_agents:
+            agent_addresses = [addr for addr in agent_addresses if addr.lower() not in replied_agents]
         
         debug_print(f"\n=== Processing Email ===")
         debug_print(f"From: {from_email}")
-        debug_print(f"To: {', '.join(to_addresses)}")
-        debug_print(f"CC: {', '.join(cc_list)}")
-        debug_print(f"Selected agent address: {clean_to_email}")
+        debug_print(f"To: {', '.join(recipients.to)}")
+        debug_print(f"CC: {', '.join(recipients.cc)}")
+        debug_print(f"Selected agent addresses: {', '.join(agent_addresses)}")
         debug_print(f"Subject: {subject}")
         debug_print(f"Has attachments: {bool(attachments)}")
         
-        ai_response = await get_ai_response(text_content, attachments, clean_to_email, subject, config['MODEL_MAPPING'])
+        if len(agent_addresses) == 1:
+            try:
+                return await reply_as_agent(
+                    config, agent_addresses[0], from_email, to_email, subject, text_content,
+                    message_id, references, attachments, cc_addresses, partial_responses=partial_responses, stats=stats,
+                    recipients=recipients
+                )
+            finally:
+                if agent_authored and thread_id:
+                    await asyncio.to_thread(loop_breaker.record_tokens, config, thread_id, stats.get('tokens'))
         
-        if any(indicator.lower() in ai_response.lower() for indicator in ["NOREPLY"]):
-            debug_print("AI indicated no reply needed - stopping processing")
-            return True, "AI determined no reply was needed", 200
-        if any(indicator.lower() in ai_response.lower() for indicator in ["NOREPLY_LOOPING"]):
-            debug_print("AI indicated looping conversation - stopping processing")
-            return True, "AI indicated looping conversation - stopping processing", 200
+        # Every agent works from the same parsed thread and encoded attachments,
+        # and each reply goes out as soon as its own model is done
+        shared = {}
+        results = await asyncio.gather(*[
+            reply_as_agent(
+                config, clean_to_email, from_email, to_email, subject, text_content,
+                message_id, references, attachments, cc_addresses, shared, partial_responses, stats, recipients
+            )
+            for clean_to_email in agent_addresses
+        ], return_exceptions=True)
+        if agent_authored and thread_id:
+            await asyncio.to_thread(loop_breaker.record_tokens, config, thread_id, stats.get('tokens'))
         
-        return await send_email_response(
-            ai_response=ai_response,
-            text_content=text_content,
-            from_email=from_email,
-            to_email=to_email,
-            subject=subject,
-            message_id=message_id,
-            references=references,
-            model_name=model_data['name'],
-            clean_to_email=clean_to_email,
-            cc_addresses=cc_addresses
-        )
+        failures = []
+        for clean_to_email, result in zip(agent_addresses, results):
+            if isinstance(result, EmailProcessingError):
+                failures.append((clean_to_email, str(result), result.status_code))
+            elif isinstance(result, Exception):
+                failures.append((clean_to_email, f"Error processing email: {str(result)}", 500))
+            elif replied_agents is not None:
+                replied_agents.append(clean_to_email.lower())
+        
+        if not failures:
+            return True, "Email processed and responses sent successfully", 200
+        for clean_to_email, message, status_code in failures:
+            debug_print(f"Email processing error for {clean_to_email}: {message}")
+        return False, '; '.join(f"{addr}: {message}" for addr, message, _ in failures), max(code for _, _, code in failures)
         
     except EmailProcessingError as e:
         debug_print(f"Email processing error: {str(e)}")
@@ -273,4 +476,4 @@ async def process_and_reply_to_email(from_email, to_email, subject, text_content
         debug_print(error_msg)
         import traceback
         debug_print(traceback.format_exc())
-        return False, error_msg, 500
\ No newline at end of file
+        return False, error_msg, 500
@@ -0,0 +1,246 @@
+# Mentat Mail: https://mentatmail.com
+# Copyright (C) 2025 Andy Bromberg andy@andybromberg.com
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import io
+import os
+import codecs
+import asyncio
+import hashlib
+import multiprocessing
+from collections import OrderedDict
+from importlib.util import find_spec
+from attachments import open_attachment
+from utils import debug_print
+import metrics
+
+# Text for the non-image attachments: plain text, CSV, JSON, Markdown, and PDF
+# when pypdf is installed. Extractors are picked by MIME type, then by file
+# extension. Each file is read in a process of its own, at most EXTRACT_WORKERS
+# at a time, and that process is killed if it runs past EXTRACT_TIMEOUT. Each
+# extractor stops reading once it has enough text for the token budget, which
+# is then shared between all the files in the email. Results are cached by
+# content hash, so the same PDF forwarded down a thread is read once.
+
+READ_CHUNK_BYTES = 64 * 1024
+PDF_MAX_PAGES = 500
+
+# spawn for the same reason as the image pool: no forking a threaded process
+_context = multiprocessing.get_context('spawn')
+_extractors = []
+_extract_slots = {}
+_extract_cache = OrderedDict()
+
+def register(name, mime_types=(), extensions=(), requires=None):
+    # requires names an optional module; the extractor is skipped without it
+    def decorator(function):
+        _extractors.append({
+            'name': name,
+            'function': function,
+            'mime_types': set(mime_types),
+            'extensions': set(extensions),
+            'requires': requires
+        })
+        return function
+    return decorator
+
+def find_extractor(filename, content_type):
+    mime_type = (content_type or '').split(';')[0].strip().lower()
+    extension = os.path.splitext((filename or '').lower())[1]
+    available = [e for e in _extractors if not e['requires'] or find_spec(e['requires']) is not None]
+    for extractor in available:
+        if mime_type in extractor['mime_types']:
+            return extractor
+    # Mail clients often send application/octet-stream, so fall back to the name
+    for extractor in available:
+        if extension in extractor['extensions']:
+            return extractor
+    return None
+
+def _open_source(source):
+    return open(source, 'rb') if isinstance(source, str) else io.BytesIO(source)
+
+@register(
+    'text',
+    mime_types={'text/plain', 'text/csv', 'text/tab-separated-values', 'text/markdown', 'text/x-markdown', 'application/json', 'application/x-ndjson'},
+    extensions={'.txt', '.text', '.log', '.csv', '.tsv', '.json', '.jsonl', '.ndjson', '.md', '.markdown'}
+)
+def extract_text(source, max_chars):
+    # Runs in an extract process. Decodes as UTF-8 a chunk at a time and stops
+    # at max_chars; returns (text, truncated)
+    decoder = codecs.getincrementaldecoder('utf-8-sig')(errors='replace')
+    parts = []
+    size = 0
+    with _open_source(source) as f:
+        while size < max_chars:
+            chunk = f.read(READ_CHUNK_BYTES)
+            if not chunk:
+                break
+            if b'\x00' in chunk:
+                raise ValueError("binary content")
+            text = decoder.decode(chunk)
+            parts.append(text)
+            size += len(text)
+        else:
+            text = ''.join(parts)
+            return text[:max_chars], len(text) > max_chars or bool(f.read(1))
+        parts.append(decoder.decode(b'', final=True))
+    return ''.join(parts), False
+
+@register('pdf', mime_types={'application/pdf'}, extensions={'.pdf'}, requires='pypdf')
+def extract_pdf(source, max_chars):
+    from pypdf import PdfReader
+
+    with _open_source(source) as f:
+        reader = PdfReader(f)
+        if reader.is_encrypted:
+            # Plenty of PDFs are "encrypted" with an empty password
+            reader.decrypt('')
+        pages = []
+        size = 0
+        for number, page in enumerate(reader.pages):
+            if number >= PDF_MAX_PAGES or size >= max_chars:
+                return '\n\n'.join(pages)[:max_chars], True
+            text = (page.extract_text() or '').strip()
+            if text:
+                pages.append(text)
+                size += len(text) + 2
+    return '\n\n'.join(pages)[:max_chars], size > max_chars
+
+def _run_extractor(connection, function, source, max_chars):
+    # Entry point of an extract process
+    try:
+        connection.send(('ok', function(source, max_chars)))
+    except Exception as e:
+        connection.send(('error', f"{type(e).__name__}: {str(e)}"))
+    finally:
+        connection.close()
+
+def _extract_in_process(function, source, max_chars, timeout):
+    # Blocking; runs in a thread. Unlike a pool worker, a process of our own
+    # can be killed when it times out without failing anyone else's file.
+    receiver, sender = _context.Pipe(duplex=False)
+    process = _context.Process(target=_run_extractor, args=(sender, function, source, max_chars), daemon=True)
+    process.start()
+    sender.close()
+    try:
+        if not receiver.poll(timeout):
+            raise asyncio.TimeoutError()
+        status, result = receiver.recv()
+    except EOFError:
+        raise RuntimeError("extract process exited without a result")
+    finally:
+        receiver.close()
+        if process.is_alive():
+            process.terminate()
+        process.join()
+    if status == 'error':
+        raise RuntimeError(result)
+    return result
+
+def _get_extract_slots(max_workers):
+    loop = asyncio.get_running_loop()
+    key = (loop, max_workers)
+    slots = _extract_slots.get(key)
+    if slots is None:
+        for stale_key in [k for k in _extract_slots if k[0].is_closed()]:
+            del _extract_slots[stale_key]
+        slots = _extract_slots[key] = asyncio.Semaphore(max_workers)
+    return slots
+
+def _digest(attachment):
+    digest = hashlib.sha256()
+    with open_attachment(attachment) as f:
+        while True:
+            chunk = f.read(READ_CHUNK_BYTES)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+async def _extract(attachment, extractor, max_chars, config):
+    key = (await asyncio.to_thread(_digest, attachment), extractor['name'], max_chars)
+    if key in _extract_cache:
+        _extract_cache.move_to_end(key)
+        metrics.inc('mentat_attachment_extractions_total', extractor=extractor['name'], outcome='cache_hit')
+        return _extract_cache[key]
+
+    source = attachment.get('path') or attachment.get('content') or b''
+    try:
+        async with _get_extract_slots(config['EXTRACT_WORKERS']):
+            result = await asyncio.to_thread(
+                _extract_in_process, extractor['function'], source, max_chars, config['EXTRACT_TIMEOUT']
+            )
+    except asyncio.TimeoutError:
+        metrics.inc('mentat_attachment_extractions_total', extractor=extractor['name'], outcome='timeout')
+        raise
+    except Exception:
+        metrics.inc('mentat_attachment_extractions_total', extractor=extractor['name'], outcome='error')
+        raise
+    metrics.inc('mentat_attachment_extractions_total', extractor=extractor['name'], outcome='ok')
+
+    _extract_cache[key] = result
+    while len(_extract_cache) > config['EXTRACT_CACHE_SIZE']:
+        _extract_cache.popitem(last=False)
+    return result
+
+def share_budget(sizes, budget):
+    # Splits budget between files as evenly as it can; files that need less
+    # than an even share leave the rest to the bigger ones
+    shares = [0] * len(sizes)
+    remaining = budget
+    order = sorted(range(len(sizes)), key=lambda i: sizes[i])
+    for position, i in enumerate(order):
+        shares[i] = min(sizes[i], remaining // (len(order) - position))
+        remaining -= shares[i]
+    return shares
+
+async def extract_attachments(attachments, token_budget, config):
+    # Returns the text to append to the prompt for attachments that have an
+    # extractor; budget is in tokens, at ~4 characters per token
+    max_chars = token_budget * 4
+    results = await asyncio.gather(*[
+        _extract(attachment, find_extractor(attachment['filename'], attachment.get('content_type')), max_chars, config)
+        for attachment in attachments
+    ], return_exceptions=True)
+
+    extracted = [(attachment, result) for attachment, result in zip(attachments, results) if not isinstance(result, BaseException)]
+    shares = iter(share_budget([len(text) for _, (text, _) in extracted], max_chars))
+
+    text_content = ""
+    for attachment, result in zip(attachments, results):
+        filename = attachment['filename']
+        if isinstance(result, asyncio.TimeoutError):
+            debug_print(f"Text extraction timed out for {filename}")
+            text_content += f"\n[Attached file: {filename} (text extraction timed out)]"
+            continue
+        if isinstance(result, BaseException):
+            debug_print(f"Could not extract text from {filename}: {str(result)}")
+            text_content += f"\n[Attached file: {filename} (could not read its contents)]"
+            continue
+
+        text, truncated = result
+        share = next(shares)
+        if not text.strip():
+            text_content += f"\n[Attached file: {filename} (no text found)]"
+            continue
+        if share < len(text):
+            text, truncated = text[:share], True
+        debug_print(f"Extracted {len(text)} characters from {filename}{' (truncated)' if truncated else ''}")
+        text_content += f"\n\n[Attached file: {filename}]\n{text.rstrip()}"
+        if truncated:
+            text_content += "\n[... rest of the file truncated]"
+        text_content += f"\n[End of {filename}]"
+    return text_content
@@ -0,0 +1,190 @@
+# Mentat Mail: https://andybromberg.com/mentat-mail
+# Copyright (C) 2025 Andy Bromberg andy@andybromberg.com
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from html.parser import HTMLParser
+
+# Plain text for HTML-only emails. One pass over the markup: scripts, styles
+# and hidden elements are dropped, entities decoded, whitespace collapsed, and
+# <blockquote> becomes "> " quote levels so threads.py can still tell the
+# messages in a reply chain apart. Output stops at max_chars, and so does
+# parsing, so a huge marketing email costs no more than a small one.
+
+MAX_TEXT_CHARS = 200000
+FEED_CHUNK_CHARS = 64 * 1024
+
+SKIP_TAGS = {'head', 'script', 'style', 'noscript', 'template', 'title', 'svg', 'math', 'iframe', 'object', 'select'}
+# Skipped until their end tag no matter what: their content is never markup
+RAW_TEXT_TAGS = {'script', 'style', 'title', 'template'}
+# Anything else starts the body, even when </head> and <body> are left out
+HEAD_TAGS = {'head', 'base', 'link', 'meta', 'title', 'style', 'script', 'noscript', 'template'}
+VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track', 'wbr'}
+# Block elements that start a new line, and the ones that also leave a blank line around them
+LINE_TAGS = {'div', 'tr', 'li', 'dt', 'dd', 'address', 'section', 'article', 'header', 'footer', 'nav', 'aside', 'main', 'figure', 'figcaption', 'center', 'form', 'fieldset', 'caption'}
+PARAGRAPH_TAGS = {'p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'ul', 'ol', 'dl', 'table', 'pre', 'blockquote', 'hr'}
+# Start tags that close an open element whose end tag was left out
+IMPLIED_END_TAGS = {
+    'p': LINE_TAGS | PARAGRAPH_TAGS | {'p'},
+    'li': {'li'},
+    'dt': {'dt', 'dd'},
+    'dd': {'dt', 'dd'},
+    'tr': {'tr'},
+    'td': {'td', 'th', 'tr'},
+    'th': {'td', 'th', 'tr'},
+    'option': {'option'}
+}
+
+def _is_hidden(attrs):
+    for name, value in attrs:
+        if name == 'hidden' or (name == 'aria-hidden' and value == 'true'):
+            return True
+        if name == 'style' and value:
+            style = value.replace(' ', '').lower()
+            if 'display:none' in style or 'visibility:hidden' in style:
+                return True
+    return False
+
+class _TextExtractor(HTMLParser):
+    def __init__(self, max_chars):
+        super().__init__(convert_charrefs=True)
+        self.max_chars = max_chars
+        self.lines = []
+        self.parts = []
+        self.size = 0
+        self.full = False
+        self.quote_level = 0
+        self.pre_depth = 0
+        self.skip_tag = None
+        self.skip_depth = 0
+        self.skip_nested = 0
+
+    def _prefix(self):
+        return '>' * self.quote_level
+
+    def _emit(self, line):
+        self.lines.append(line)
+        self.size += len(line) + 1
+        if self.size >= self.max_chars:
+            self.full = True
+
+    def _flush(self):
+        text = ''.join(self.parts)
+        self.parts = []
+        text = text.rstrip() if self.pre_depth else ' '.join(text.split())
+        if text:
+            prefix = self._prefix()
+            self._emit(f"{prefix} {text}" if prefix else text)
+
+    def _break(self, blank=False):
+        self._flush()
+        if blank and self.lines and self.lines[-1].strip('>'):
+            self._emit(self._prefix())
+
+    def _skip_ends_at(self, tag):
+        # Whether tag starting inside the skipped element implicitly closes it
+        if self.skip_tag in RAW_TEXT_TAGS:
+            return False
+        if self.skip_tag == 'head':
+            return tag not in HEAD_TAGS
+        if self.skip_depth != 1 or tag not in IMPLIED_END_TAGS.get(self.skip_tag, ()):
+            return False
+        # <p> can't contain blocks, but a hidden <li> can hold a whole nested list
+        return self.skip_tag == 'p' or not self.skip_nested
+
+    def handle_starttag(self, tag, attrs):
+        if self.skip_tag:
+            if not self._skip_ends_at(tag):
+                if tag == self.skip_tag:
+                    self.skip_depth += 1
+                elif tag not in VOID_TAGS:
+                    self.skip_nested += 1
+                return
+            self.skip_tag = None
+        if tag in SKIP_TAGS or (tag not in VOID_TAGS and _is_hidden(attrs)):
+            self.skip_tag, self.skip_depth, self.skip_nested = tag, 1, 0
+            return
+
+        if tag == 'br':
+            self._flush()
+        elif tag in PARAGRAPH_TAGS:
+            self._break(blank=True)
+        elif tag in LINE_TAGS:
+            self._break()
+        elif tag in ('td', 'th'):
+            self.parts.append(' ')
+
+        if tag == 'blockquote':
+            self.quote_level += 1
+        elif tag == 'pre':
+            self.pre_depth += 1
+        elif tag == 'li':
+            self.parts.append('- ')
+        elif tag == 'img':
+            # Tracking pixels and spacers have no alt text, so they vanish
+            alt = dict(attrs).get('alt') or ''
+            if alt.strip():
+                self.parts.append(f" [image: {alt.strip()}] ")
+
+    def handle_endtag(self, tag):
+        if self.skip_tag:
+            if tag == self.skip_tag:
+                self.skip_depth -= 1
+                if not self.skip_depth:
+                    self.skip_tag = None
+            elif tag not in VOID_TAGS:
+                self.skip_nested = max(0, self.skip_nested - 1)
+            return
+
+        if tag == 'blockquote':
+            self._flush()
+            self.quote_level = max(0, self.quote_level - 1)
+            self._break(blank=True)
+        elif tag in PARAGRAPH_TAGS:
+            self._break(blank=True)
+        elif tag in LINE_TAGS:
+            self._break()
+
+        if tag == 'pre' and self.pre_depth:
+            self.pre_depth -= 1
+
+    def handle_data(self, data):
+        if self.skip_tag or self.full:
+            return
+        if self.pre_depth and '\n' in data:
+            first, *rest = data.split('\n')
+            self.parts.append(first)
+            for line in rest:
+                self._flush()
+                self.parts.append(line)
+        else:
+            self.parts.append(data)
+
+def html_to_text(html, max_chars=MAX_TEXT_CHARS):
+    parser = _TextExtractor(max_chars)
+    for start in range(0, len(html), FEED_CHUNK_CHARS):
+        parser.feed(html[start:start + FEED_CHUNK_CHARS])
+        if parser.full:
+            break
+    else:
+        parser.close()
+    parser._flush()
+
+    lines = parser.lines
+    while lines and not lines[-1].strip('> '):
+        lines.pop()
+    text = '\n'.join(lines)
+    if parser.full:
+        text = text[:max_chars].rstrip() + "\n[... rest of the email truncated]"
+    return text
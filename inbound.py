@@ -0,0 +1,143 @@
+# Mentat Mail: https://andybromberg.com/mentat-mail
+# Copyright (C) 2025 Andy Bromberg andy@andybromberg.com
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+from email_processor import get_agent_address, get_provider_for_email
+from utils import debug_print, is_email_whitelisted
+from recipients import Recipients
+from html_text import html_to_text
+import job_queue
+import dedup
+import metrics
+
+# The /inbound contract, shared by the Flask app (app.py) and the ASGI app
+# (asgi.py). Both parse SendGrid's multipart body into a form and files with
+# Werkzeug, then hand them to accept_inbound, which is blocking (SQLite and
+# spool writes) and returns (body, status).
+
+@metrics.timed('inbound')
+def accept_inbound(config, form, files):
+    claimed = False
+    original_message_id = None
+    agent_address = None
+    try:
+        sender = form.get('from', '')
+        subject = form.get('subject', '')
+        original_message_id = form.get('Message-ID') or form.get('message-id')
+        references = form.get('References', '')
+        to = form.get('to', '')
+        cc = form.get('cc', '')
+
+        # Before anything is claimed, spooled or queued: the webhook is public
+        sender_email = Recipients.parse(sender, to, cc).sender.lower()
+        if not is_email_whitelisted(sender_email, config['WHITELIST']):
+            debug_print(f"Rejected email from non-whitelisted sender: {sender_email}")
+            return "Sender email not whitelisted", 403
+
+        agent_address = get_agent_address(to, cc, config['MODEL_MAPPING'])
+
+        if not dedup.claim_message(config, original_message_id, agent_address):
+            return "OK", 200
+        claimed = True
+
+        if original_message_id:
+            thread_references = f"{references} {original_message_id}" if references else original_message_id
+        else:
+            thread_references = None
+
+        debug_print("Form data:", dict(form))
+        debug_print("Files:", len(files))
+
+        text = form.get('text', '')
+        html = form.get('html', '')
+
+        debug_print("\n=== Email Content Debug ===")
+        debug_print("Text content:")
+        debug_print(text)
+        debug_print("\nHTML content:")
+        debug_print(html)
+        debug_print("=========================\n")
+
+        if text:
+            try:
+                if isinstance(text, bytes):
+                    text.decode('utf-8')
+                else:
+                    text.encode('utf-8').decode('utf-8')
+                content = text.strip()
+            except UnicodeError:
+                content = "No text content provided"
+        elif html:
+            content = html_to_text(html).strip() or "No text content provided"
+        else:
+            content = "No text content provided"
+
+        job_id = job_queue.new_job_id()
+        spool_dir = job_queue.job_spool_dir(config, job_id)
+        attachments = []
+        for index, (field_name, file) in enumerate(files.items()):
+            # SendGrid names the fields attachment1, attachment2, ...; the
+            # extension the extractors and image detection go by is on the file
+            filename = getattr(file, 'filename', None) or field_name
+            try:
+                content_type = file.content_type if hasattr(file, 'content_type') else None
+                if getattr(file.stream, 'oversized', False):
+                    attachments.append({
+                        'filename': filename,
+                        'content_type': content_type,
+                        'size': file.stream.size,
+                        'oversized': True
+                    })
+                    debug_print(f"Skipped attachment over size limit: {filename} ({file.stream.size} bytes)")
+                    continue
+                os.makedirs(spool_dir, exist_ok=True)
+                path = os.path.join(spool_dir, str(index))
+                file.save(path)
+                attachments.append({
+                    'filename': filename,
+                    'path': path,
+                    'content_type': content_type,
+                    'size': os.path.getsize(path)
+                })
+                debug_print(f"Processed attachment: {filename} (size: {attachments[-1]['size']} bytes)")
+            except Exception as e:
+                debug_print(f"Error processing attachment {filename}: {str(e)}")
+
+        job_queue.enqueue_job(config, job_id, get_provider_for_email(agent_address, config['MODEL_MAPPING']), {
+            'from_email': sender,
+            'to_email': to,
+            'subject': subject,
+            'text_content': content,
+            'message_id': original_message_id,
+            'references': thread_references,
+            'attachments': attachments if attachments else None,
+            'cc_addresses': cc,
+            'replied_agents': [],
+            'partial_responses': {}
+        })
+        claimed = False
+
+        return "OK", 200
+
+    except Exception as e:
+        if claimed:
+            # We never queued this one, so let SendGrid's retry go through
+            dedup.release_message(config, original_message_id, agent_address)
+        error_msg = f"Error processing inbound email: {str(e)}"
+        debug_print(error_msg)
+        import traceback
+        debug_print(traceback.format_exc())
+        return error_msg, 400
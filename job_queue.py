@@ -0,0 +1,239 @@
+# Mentat Mail: https://mentatmail.com
+# Copyright (C) 2025 Andy Bromberg andy@andybromberg.com
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import json
+import time
+import uuid
+import random
+import shutil
+import sqlite3
+import asyncio
+import threading
+import metrics
+from utils import debug_print
+
+# Jobs live in a small SQLite table so they survive restarts and can be shared
+# between gunicorn processes. A row is claimed by moving it to 'running' and
+# pushing available_at out by the lease; if the worker dies, the lease expires
+# and another worker picks the job back up.
+
+_worker_loop = None
+_worker_event = None
+
+def _connect(config):
+    conn = sqlite3.connect(config['QUEUE_DB_PATH'], timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def init_queue(config):
+    os.makedirs(config['QUEUE_SPOOL_DIR'], exist_ok=True)
+    conn = _connect(config)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                provider TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                available_at REAL NOT NULL,
+                created_at REAL NOT NULL,
+                last_error TEXT
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, available_at)")
+    finally:
+        conn.close()
+
+def new_job_id():
+    return uuid.uuid4().hex
+
+def job_spool_dir(config, job_id):
+    return os.path.join(config['QUEUE_SPOOL_DIR'], job_id)
+
+def enqueue_job(config, job_id, provider, payload):
+    now = time.time()
+    conn = _connect(config)
+    try:
+        conn.execute(
+            "INSERT INTO jobs (id, provider, payload, status, attempts, available_at, created_at) VALUES (?, ?, ?, 'pending', 0, ?, ?)",
+            (job_id, provider or 'default', json.dumps(payload), now, now)
+        )
+    finally:
+        conn.close()
+    debug_print(f"Enqueued job {job_id} for provider {provider}")
+    notify_workers()
+    return job_id
+
+def notify_workers():
+    if _worker_loop is not None and _worker_event is not None:
+        try:
+            _worker_loop.call_soon_threadsafe(_worker_event.set)
+        except RuntimeError:
+            pass
+
+def claim_job(config, saturated_providers):
+    now = time.time()
+    conn = _connect(config)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        query = "SELECT * FROM jobs WHERE status IN ('pending', 'running') AND available_at <= ?"
+        params = [now]
+        if saturated_providers:
+            query += f" AND provider NOT IN ({', '.join('?' for _ in saturated_providers)})"
+            params.extend(saturated_providers)
+        query += " ORDER BY available_at LIMIT 1"
+        row = conn.execute(query, params).fetchone()
+        if row is None:
+            conn.execute("COMMIT")
+            return None
+        conn.execute(
+            "UPDATE jobs SET status = 'running', attempts = attempts + 1, available_at = ? WHERE id = ?",
+            (now + config['QUEUE_LEASE_SECONDS'], row['id'])
+        )
+        conn.execute("COMMIT")
+        job = dict(row)
+        job['attempts'] += 1
+        job['payload'] = json.loads(job['payload'])
+        return job
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+def extend_lease(config, job_id):
+    conn = _connect(config)
+    try:
+        conn.execute(
+            "UPDATE jobs SET available_at = ? WHERE id = ? AND status = 'running'",
+            (time.time() + config['QUEUE_LEASE_SECONDS'], job_id)
+        )
+    finally:
+        conn.close()
+
+def complete_job(config, job_id):
+    conn = _connect(config)
+    try:
+        conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+    finally:
+        conn.close()
+    shutil.rmtree(job_spool_dir(config, job_id), ignore_errors=True)
+
+def fail_job(config, job, error):
+    conn = _connect(config)
+    try:
+        # The handler may have recorded progress in the payload (e.g. which
+        # agents already replied), so the retry picks up where this run left off
+        conn.execute("UPDATE jobs SET payload = ? WHERE id = ?", (json.dumps(job['payload']), job['id']))
+        if job['attempts'] >= config['QUEUE_MAX_ATTEMPTS']:
+            conn.execute("UPDATE jobs SET status = 'failed', last_error = ? WHERE id = ?", (error, job['id']))
+            debug_print(f"Job {job['id']} failed permanently after {job['attempts']} attempts: {error}")
+            retrying = False
+        else:
+            delay = min(300, 2 ** job['attempts']) * random.uniform(0.5, 1.5)
+            conn.execute(
+                "UPDATE jobs SET status = 'pending', available_at = ?, last_error = ? WHERE id = ?",
+                (time.time() + delay, error, job['id'])
+            )
+            debug_print(f"Job {job['id']} will retry in {delay:.1f}s: {error}")
+            retrying = True
+    finally:
+        conn.close()
+    if not retrying:
+        shutil.rmtree(job_spool_dir(config, job['id']), ignore_errors=True)
+    return retrying
+
+def provider_limit(config, provider):
+    return int(config['QUEUE_CONCURRENCY'].get(provider, config['QUEUE_DEFAULT_CONCURRENCY']))
+
+async def _run_job(config, handler, job):
+    payload = job['payload']
+    debug_print(f"Running job {job['id']} (attempt {job['attempts']})")
+    try:
+        task = asyncio.ensure_future(handler(**payload))
+        # Keep the lease fresh while slow models are thinking
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=config['QUEUE_LEASE_SECONDS'] / 3)
+            if done:
+                break
+            await asyncio.to_thread(extend_lease, config, job['id'])
+        success, message, status_code = task.result()
+    except Exception as e:
+        success, message, status_code = False, f"Error running job: {str(e)}", 500
+
+    if success or status_code < 500:
+        if not success:
+            debug_print(f"Job {job['id']} rejected: {message} ({status_code})")
+        await asyncio.to_thread(complete_job, config, job['id'])
+        metrics.inc('mentat_jobs_total', outcome='completed' if success else 'rejected')
+    else:
+        retrying = await asyncio.to_thread(fail_job, config, job, message)
+        metrics.inc('mentat_jobs_total', outcome='retried' if retrying else 'failed')
+
+async def run_workers(config, handler):
+    global _worker_loop, _worker_event
+    init_queue(config)
+    _worker_loop = asyncio.get_running_loop()
+    _worker_event = asyncio.Event()
+    running = {}
+    tasks = set()
+
+    def on_done(task, provider):
+        tasks.discard(task)
+        running[provider] -= 1
+        _worker_event.set()
+
+    debug_print("Job queue workers started")
+    try:
+        while True:
+            _worker_event.clear()
+            saturated = [provider for provider, count in running.items() if count >= provider_limit(config, provider)]
+            try:
+                job = await asyncio.to_thread(claim_job, config, saturated)
+            except sqlite3.Error as e:
+                debug_print(f"Error claiming job: {str(e)}")
+                job = None
+
+            if job is None:
+                try:
+                    await asyncio.wait_for(_worker_event.wait(), timeout=config['QUEUE_POLL_SECONDS'])
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            provider = job['provider']
+            running[provider] = running.get(provider, 0) + 1
+            task = asyncio.create_task(_run_job(config, handler, job))
+            tasks.add(task)
+            task.add_done_callback(lambda t, p=provider: on_done(t, p))
+    finally:
+        # Jobs cut short here keep their lease and are picked up again once it expires
+        for task in list(tasks):
+            task.cancel()
+
+def start_worker_thread(config, handler):
+    thread = threading.Thread(target=lambda: asyncio.run(run_workers(config, handler)), name='mentat-job-queue', daemon=True)
+    thread.start()
+    return thread
+
+if __name__ == '__main__':
+    from config import get_configuration, install_reload_signal
+    from email_processor import process_and_reply_to_email
+    install_reload_signal()
+    asyncio.run(run_workers(get_configuration(), process_and_reply_to_email))
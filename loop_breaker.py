@@ -0,0 +1,125 @@
+# Mentat Mail: https://mentatmail.com
+# Copyright (C) 2025 Andy Bromberg andy@andybromberg.com
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import random
+import sqlite3
+from utils import debug_print
+
+# Backstop for agent-on-agent threads, so we don't rely only on the model
+# deciding to say NOREPLY_LOOPING. Per thread (keyed on the root of the
+# References chain) we count agent-authored turns since the last human
+# message, how many of them came in quick succession, and the tokens they
+# cost. Past any threshold the breaker trips and no LLM is called until a
+# human writes on the thread again.
+
+_db_ready = set()
+
+def _connect(config):
+    conn = sqlite3.connect(config['QUEUE_DB_PATH'], timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    if config['QUEUE_DB_PATH'] not in _db_ready:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS thread_state (
+                thread_id TEXT PRIMARY KEY,
+                last_message_id TEXT,
+                agent_turns INTEGER NOT NULL DEFAULT 0,
+                fast_turns INTEGER NOT NULL DEFAULT 0,
+                agent_tokens INTEGER NOT NULL DEFAULT 0,
+                last_agent_turn_at REAL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS thread_state_age ON thread_state (updated_at)")
+        _db_ready.add(config['QUEUE_DB_PATH'])
+    return conn
+
+def is_agent_sender(sender_email, agent_addresses):
+    # Anything sent from the inbound parse domain is an agent reply: addresses
+    # that aren't in MODEL_MAPPING are answered by the default model, so
+    # they're agents too
+    domain = sender_email.lower().partition('@')[2]
+    return bool(domain) and domain in {address.lower().partition('@')[2] for address in agent_addresses}
+
+def record_turn(config, thread_id, message_id, agent_authored):
+    now = time.time()
+    conn = _connect(config)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT * FROM thread_state WHERE thread_id = ?", (thread_id,)).fetchone()
+        state = dict(row) if row else {
+            'thread_id': thread_id, 'last_message_id': None, 'agent_turns': 0,
+            'fast_turns': 0, 'agent_tokens': 0, 'last_agent_turn_at': None
+        }
+        # A retried job is the same turn, not a new one
+        if message_id is None or state['last_message_id'] != message_id:
+            if agent_authored:
+                last = state['last_agent_turn_at']
+                fast = last is not None and now - last < config['LOOP_MIN_TURN_SECONDS']
+                state['agent_turns'] += 1
+                state['fast_turns'] = state['fast_turns'] + 1 if fast else 0
+                state['last_agent_turn_at'] = now
+            else:
+                # A human chimed in, which resets the breaker
+                state.update(agent_turns=0, fast_turns=0, agent_tokens=0, last_agent_turn_at=None)
+            state['last_message_id'] = message_id
+        conn.execute(
+            "INSERT OR REPLACE INTO thread_state (thread_id, last_message_id, agent_turns, fast_turns, agent_tokens, last_agent_turn_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (thread_id, state['last_message_id'], state['agent_turns'], state['fast_turns'], state['agent_tokens'], state['last_agent_turn_at'], now)
+        )
+        if random.random() < 0.01:
+            conn.execute("DELETE FROM thread_state WHERE updated_at < ?", (now - config['LOOP_STATE_TTL_SECONDS'],))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    return state
+
+def record_tokens(config, thread_id, tokens):
+    if not tokens:
+        return
+    conn = _connect(config)
+    try:
+        conn.execute(
+            "UPDATE thread_state SET agent_tokens = agent_tokens + ?, updated_at = ? WHERE thread_id = ?",
+            (int(tokens), time.time(), thread_id)
+        )
+    finally:
+        conn.close()
+
+def trip_reason(state, config):
+    if state['agent_turns'] >= config['LOOP_MAX_AGENT_TURNS']:
+        return f"{state['agent_turns']} agent turns in a row"
+    if state['fast_turns'] >= config['LOOP_MAX_FAST_TURNS']:
+        return f"{state['fast_turns']} agent turns less than {config['LOOP_MIN_TURN_SECONDS']}s apart"
+    if state['agent_tokens'] >= config['LOOP_MAX_AGENT_TOKENS']:
+        return f"{state['agent_tokens']} tokens spent on agent turns"
+    return None
+
+def check_thread(config, thread_id, message_id, agent_authored):
+    if not thread_id:
+        return None
+    try:
+        state = record_turn(config, thread_id, message_id, agent_authored)
+    except sqlite3.Error as e:
+        debug_print(f"Loop breaker state unavailable, letting the email through: {str(e)}")
+        return None
+    reason = trip_reason(state, config)
+    if reason:
+        debug_print(f"Loop breaker tripped for thread {thread_id}: {reason}")
+    return reason
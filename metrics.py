@@ -0,0 +1,124 @@
+# Mentat Mail: https://andybromberg.com/mentat-mail
+# Copyright (C) 2025 Andy Bromberg andy@andybromberg.com
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import json
+import time
+import random
+import logging
+import threading
+from contextlib import contextmanager
+from utils import get_logger
+
+# In-process counters and histograms, rendered in the Prometheus text format
+# on /metrics. Recording is a dict update under a lock, so it's cheap enough
+# for the hot path. Each server process keeps its own numbers; with more than
+# one worker process, scrape each one or run a single worker.
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+METRICS = {
+    'mentat_stage_seconds': ('histogram', "Time spent in each stage of handling an email"),
+    'mentat_llm_tokens_total': ('counter', "Tokens reported by the LLM provider"),
+    'mentat_llm_calls_total': ('counter', "LLM calls by outcome"),
+    'mentat_prompt_cache_total': ('counter', "LLM calls whose prompt prefix was (hit) or wasn't (miss) served from the provider's cache"),
+    'mentat_attachment_extractions_total': ('counter', "Attachment text extractions by extractor and outcome"),
+    'mentat_emails_total': ('counter', "Emails processed by outcome"),
+    'mentat_jobs_total': ('counter', "Queue jobs finished by outcome")
+}
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_timing_logger = logging.getLogger('mentat.timings')
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+def inc(name, amount=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+def observe(name, value, **labels):
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0, 'count': 0}
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                histogram['buckets'][i] += 1
+                break
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+@contextmanager
+def timed(stage, timings=None, **labels):
+    # Records how long the block took under mentat_stage_seconds, and in
+    # timings (a dict) if given, for the per-email timing log
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        observe('mentat_stage_seconds', elapsed, stage=stage, **labels)
+        if timings is not None:
+            timings[stage] = round(timings.get(stage, 0) + elapsed, 4)
+
+def log_timings(timings, **fields):
+    # One JSON line per email, for a TIMING_LOG_SAMPLE_RATE fraction of them
+    rate = float(os.getenv('TIMING_LOG_SAMPLE_RATE', '0'))
+    if rate <= 0 or random.random() >= rate:
+        return
+    get_logger()
+    _timing_logger.info(json.dumps(dict(fields, timings=timings), default=str))
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+def render():
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: {'buckets': list(h['buckets']), 'sum': h['sum'], 'count': h['count']} for key, h in _histograms.items()}
+
+    lines = []
+    for name, (kind, help_text) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == 'counter':
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+        else:
+            for (metric, labels), histogram in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, histogram['buckets']):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels, [('le', f'{bound:g}')])} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {histogram['sum']:.6f}")
+                lines.append(f"{name}_count{_format_labels(labels)} {histogram['count']}")
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,84 @@
+# Mentat Mail: https://mentatmail.com
+# Copyright (C) 2025 Andy Bromberg andy@andybromberg.com
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from string import Formatter
+
+# Everything that changes per email (subject, agent, date) comes after
+# SYSTEM_PROMPT, at the very end, so the text before it is identical on every
+# request and providers can cache it as a prompt prefix.
+
+SYSTEM_PROMPT_TEMPLATE = """You are an AI assistant participating in an email thread. The message you receive will contain the full email thread, with the most recent message at the top. Email threads are typically marked with ">" characters at the start of quoted lines, with more ">" characters indicating older messages.
+
+IMPORTANT:
+1. Only respond to the most recent message (the text at the top before any ">" marks)
+2. Use the quoted/older messages (typically marked with ">") only for context to understand what was previously discussed and to inform your response to the most recent message. Read carefully and make sure you're paying attention to the logical sequence of the messages (most recent at the top).
+3. If you're HIGHLY confident there is anything for you to respond to in the most recent message, reply with "NOREPLY" — for example: if there are multiple people on the thread and the most recent message is clearly addressed to someone else and not you, simply say "NOREPLY" - however, err on the side of responding normally; only use NOREPLY if you're confident there's nothing to reply to. Most of the time, when you're on a thread and a question is posed, it is meant for you, so do not use NOREPLY.
+4. When responding in a group thread:
+   - Pay attention to who the message is addressed to (look for "@name" or direct addressing)
+   - Only respond if you're directly addressed or if the question/discussion is relevant to your role
+   - Be mindful not to interrupt conversations between other participants
+
+There is a possibility of a situation where you and another AI agent go back and forth endlessly in an unproductive way. If you think this might be happening, you should reply once saying that you're wondering if that's what is happening and ask a human if you should keep responding. After that, reply "NOREPLY_LOOPING" unless a human affirms you should continue. If you really think it's happening or a looping conversation is continuing, simply reply "NOREPLY_LOOPING"
+
+Aside from those specific and IMPORTANT instructions, here are general instructions for how you should reply:
+
+{system_prompt}
+
+Additional context:
+- The subject of the email is: {subject}
+- Your email address is {agent_email}. As you're reviewing the thread, you may see prior messages from yourself.
+- You might be addressed by the names "Mentat" or "{agent_name}" or something similar
+- The current date is {current_date}."""
+
+def compile_prompt_template(template, **static_values):
+    # Split the template once into (literal, field) pairs, folding in values
+    # that only change when the configuration does (like SYSTEM_PROMPT), so
+    # rendering per email is just a join.
+    parts = []
+    literal = ''
+    for text, field, _, _ in Formatter().parse(template):
+        literal += text
+        if field is None:
+            continue
+        if field in static_values:
+            literal += str(static_values[field])
+        else:
+            parts.append((literal, field))
+            literal = ''
+    parts.append((literal, None))
+    return tuple(parts)
+
+def render_prompt(compiled_template, **values):
+    return ''.join(
+        literal + (str(values[field]) if field is not None else '')
+        for literal, field in compiled_template
+    )
+
+def render_prompt_parts(compiled_template, **values):
+    # (prefix, suffix): the prefix is the text before the first per-email
+    # field, which only changes with the configuration
+    prefix, first_field = compiled_template[0]
+    return prefix, render_prompt((('', first_field),) + compiled_template[1:], **values)
+
+def system_message(prefix, suffix, cache_prefix=False):
+    if not cache_prefix:
+        return {"role": "system", "content": prefix + suffix}
+    # Explicit cache breakpoint, for providers (Anthropic) that only cache
+    # what they're told to; litellm passes cache_control through
+    return {"role": "system", "content": [
+        {"type": "text", "text": prefix, "cache_control": {"type": "ephemeral"}},
+        {"type": "text", "text": suffix}
+    ]}
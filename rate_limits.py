@@ -0,0 +1,130 @@
+# Mentat Mail: https://mentatmail.com
+# Copyright (C) 2025 Andy Bromberg andy@andybromberg.com
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import asyncio
+from contextlib import asynccontextmanager
+import metrics
+from utils import debug_print, estimate_tokens
+
+# Limits come from PROVIDER_LIMITS (per provider) and from the same keys on a
+# MODEL_MAPPING entry (per model): 'concurrency' caps in-flight calls, 'rpm'
+# and 'tpm' are token buckets for requests and tokens per minute. Callers
+# wait in FIFO order, so a burst of emails drains in arrival order instead
+# of all hitting the provider at once and failing with 429s.
+
+_limiters = {}
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.refill_per_second = per_minute / 60.0
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_per_second)
+        self.updated_at = now
+
+    async def acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        # Holding the lock while we wait is what makes this fair: nobody can
+        # jump ahead of a large request that is waiting for the bucket to fill
+        async with self.lock:
+            self._refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.refill_per_second)
+                self._refill()
+            self.tokens -= amount
+
+    def adjust(self, amount):
+        # Correct an estimate once the real usage is known; refunds are capped
+        # at capacity and overspend just pushes the bucket negative for a while
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+class Usage:
+    def __init__(self, token_buckets, estimated_tokens):
+        self.token_buckets = token_buckets
+        self.estimated_tokens = estimated_tokens
+
+    def record(self, total_tokens):
+        if total_tokens is None:
+            return
+        for bucket in self.token_buckets:
+            bucket.adjust(total_tokens - min(self.estimated_tokens, bucket.capacity))
+
+def _get_limiters(key, limits):
+    loop = asyncio.get_running_loop()
+    cache_key = (loop, key, limits.get('concurrency'), limits.get('rpm'), limits.get('tpm'))
+    limiters = _limiters.get(cache_key)
+    if limiters is None:
+        for stale_key in [k for k in _limiters if k[0].is_closed()]:
+            del _limiters[stale_key]
+        limiters = {
+            'semaphore': asyncio.Semaphore(int(limits['concurrency'])) if limits.get('concurrency') else None,
+            'rpm': TokenBucket(limits['rpm']) if limits.get('rpm') else None,
+            'tpm': TokenBucket(limits['tpm']) if limits.get('tpm') else None
+        }
+        _limiters[cache_key] = limiters
+    return limiters
+
+def estimate_message_tokens(messages):
+    # Text at ~4 characters per token, plus a flat cost per image
+    total = 0
+    for message in messages:
+        content = message['content']
+        if isinstance(content, str):
+            total += estimate_tokens(content)
+            continue
+        for part in content:
+            if part.get('type') == 'text':
+                total += estimate_tokens(part['text'])
+            else:
+                total += 1000
+    return total
+
+@asynccontextmanager
+async def limit(model_info, provider_limits, estimated_tokens):
+    scopes = [
+        (f"model:{model_info.get('model')}", model_info),
+        (f"provider:{model_info.get('provider')}", provider_limits.get(model_info.get('provider'), {}))
+    ]
+    acquired = []
+    token_buckets = []
+    started = time.monotonic()
+    try:
+        # Always model first, then provider, so waiters can't deadlock
+        for key, limits in scopes:
+            limiters = _get_limiters(key, limits)
+            if limiters['semaphore'] is not None:
+                await limiters['semaphore'].acquire()
+                acquired.append(limiters['semaphore'])
+            if limiters['rpm'] is not None:
+                await limiters['rpm'].acquire(1)
+            if limiters['tpm'] is not None:
+                await limiters['tpm'].acquire(estimated_tokens)
+                token_buckets.append(limiters['tpm'])
+        waited = time.monotonic() - started
+        metrics.observe('mentat_stage_seconds', waited, stage='rate_limit_wait', model=model_info.get('model'))
+        if waited > 0.5:
+            debug_print(f"Waited {waited:.1f}s for rate limits on {model_info.get('model')}")
+        yield Usage(token_buckets, estimated_tokens)
+    finally:
+        for semaphore in reversed(acquired):
+            semaphore.release()
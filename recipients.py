@@ -0,0 +1,74 @@
+# Mentat Mail: https://andybromberg.com/mentat-mail
+# Copyright (C) 2025 Andy Bromberg andy@andybromberg.com
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from email.utils import getaddresses
+from utils import extract_email
+
+# From/To/CC are parsed once per email into a Recipients object, which agent
+# selection, the whitelist check and reply addressing then share. Parsing goes
+# through email.utils.getaddresses, so display names with commas in them
+# ("Doe, Jane" <jane@example.com>) don't get split into two bogus addresses.
+
+def parse_address_list(value):
+    if not value:
+        return []
+    fields = [value] if isinstance(value, str) else [field for field in value if field and field.strip()]
+    addresses = []
+    for name, address in getaddresses(fields):
+        # getaddresses passes through what it can't parse ("Jane Doe
+        # jane@x.com", the "Doe" of an unquoted "Doe, Jane <jane@x.com>"), so
+        # run the lenient extraction we've always done over every entry and
+        # drop whatever still isn't an address; SendGrid rejects those
+        address = extract_email(address if '@' in address else f"{name} {address}")
+        if '@' in address:
+            addresses.append(address)
+    return addresses
+
+def _unique(addresses, exclude=()):
+    seen = {address.lower() for address in exclude}
+    unique = []
+    for address in addresses:
+        key = address.lower()
+        if key not in seen:
+            seen.add(key)
+            unique.append(address)
+    return unique
+
+class Recipients:
+    def __init__(self, sender, to, cc):
+        self.sender = sender
+        self.to = to
+        self.cc = cc
+
+    @classmethod
+    def parse(cls, from_email, to_email, cc_addresses=''):
+        senders = parse_address_list(from_email)
+        return cls(senders[-1] if senders else '', parse_address_list(to_email), parse_address_list(cc_addresses))
+
+    def agent_addresses(self, model_mapping):
+        # Every addressed agent, To before CC; if none is a known model, the
+        # first recipient (which will use the default model)
+        agents = _unique(address for address in self.to + self.cc if address.split('@')[0].lower() in model_mapping)
+        if not agents and (self.to or self.cc):
+            agents = [(self.to + self.cc)[0]]
+        return agents
+
+    def reply_addresses(self, agent_address):
+        # Reply-all from agent_address: the original sender first, then the
+        # other To and CC recipients, each address only once
+        to = _unique(([self.sender] if self.sender else []) + self.to, exclude=[agent_address])
+        cc = _unique(self.cc, exclude=[agent_address] + to)
+        return to, cc
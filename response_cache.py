@@ -0,0 +1,145 @@
+# Mentat Mail: https://mentatmail.com
+# Copyright (C) 2025 Andy Bromberg andy@andybromberg.com
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import time
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from utils import debug_print
+
+# Opt-in per model with "cache": true on its MODEL_MAPPING / MODEL_ALIASES
+# entry. Mostly useful for deterministic aliases (e.g. "temperature": 0): the
+# same thread sent again - CC'd, forwarded or retried - gets the same answer
+# without another provider round trip. Entries are kept in an in-memory LRU
+# capped at RESPONSE_CACHE_MAX_BYTES, and also written to SQLite when
+# RESPONSE_CACHE_PATH is set so they survive restarts.
+
+_memory = OrderedDict()
+_memory_bytes = 0
+_lock = threading.Lock()
+_db_ready = set()
+
+def _normalize_content(content):
+    if isinstance(content, str):
+        return ' '.join(content.split())
+    parts = []
+    for part in content:
+        if part.get('type') == 'text':
+            parts.append({'type': 'text', 'text': ' '.join(part['text'].split())})
+        elif part.get('type') == 'image_url':
+            # Hash the data URL rather than keeping megabytes of base64 in the key
+            url = part['image_url']['url']
+            parts.append({'type': 'image_url', 'digest': hashlib.sha256(url.encode('utf-8')).hexdigest()})
+        else:
+            parts.append(part)
+    return parts
+
+def make_key(model, params, messages):
+    normalized = {
+        'model': model,
+        'params': params,
+        'messages': [{'role': m['role'], 'content': _normalize_content(m['content'])} for m in messages]
+    }
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode('utf-8')).hexdigest()
+
+def _remember(key, response, max_bytes):
+    global _memory_bytes
+    with _lock:
+        if key in _memory:
+            _memory_bytes -= len(_memory.pop(key))
+        _memory[key] = response
+        _memory_bytes += len(response)
+        while _memory_bytes > max_bytes and _memory:
+            _, evicted = _memory.popitem(last=False)
+            _memory_bytes -= len(evicted)
+
+def _connect(path):
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    if path not in _db_ready:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS response_cache (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS response_cache_lru ON response_cache (last_used)")
+        _db_ready.add(path)
+    return conn
+
+def _disk_get(path, key):
+    conn = _connect(path)
+    try:
+        row = conn.execute("SELECT response FROM response_cache WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            conn.execute("UPDATE response_cache SET last_used = ? WHERE key = ?", (time.time(), key))
+        return row[0] if row else None
+    finally:
+        conn.close()
+
+def _disk_put(path, key, response, max_bytes):
+    conn = _connect(path)
+    try:
+        conn.execute(
+            "INSERT OR REPLACE INTO response_cache (key, response, size, last_used) VALUES (?, ?, ?, ?)",
+            (key, response, len(response), time.time())
+        )
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM response_cache").fetchone()[0]
+        if total > max_bytes:
+            # Drop least recently used rows until we're back under the cap
+            conn.execute("""
+                DELETE FROM response_cache WHERE key IN (
+                    SELECT key FROM (
+                        SELECT key, SUM(size) OVER (ORDER BY last_used DESC) AS running
+                        FROM response_cache
+                    ) WHERE running > ?
+                )
+            """, (max_bytes,))
+    finally:
+        conn.close()
+
+async def get(config, key):
+    with _lock:
+        if key in _memory:
+            _memory.move_to_end(key)
+            debug_print(f"Response cache hit (memory): {key[:12]}")
+            return _memory[key]
+
+    if config['RESPONSE_CACHE_PATH']:
+        try:
+            response = await asyncio.to_thread(_disk_get, config['RESPONSE_CACHE_PATH'], key)
+        except sqlite3.Error as e:
+            debug_print(f"Response cache read failed: {str(e)}")
+            return None
+        if response is not None:
+            debug_print(f"Response cache hit (disk): {key[:12]}")
+            _remember(key, response, config['RESPONSE_CACHE_MAX_BYTES'])
+            return response
+    return None
+
+async def put(config, key, response):
+    if not response:
+        return
+    _remember(key, response, config['RESPONSE_CACHE_MAX_BYTES'])
+    if config['RESPONSE_CACHE_PATH']:
+        try:
+            await asyncio.to_thread(_disk_put, config['RESPONSE_CACHE_PATH'], key, response, config['RESPONSE_CACHE_MAX_BYTES'])
+        except sqlite3.Error as e:
+            debug_print(f"Response cache write failed: {str(e)}")
@@ -0,0 +1,26 @@
+import pytest
+import job_queue
+import dedup
+from config import load_configuration
+
+@pytest.fixture
+def config(tmp_path, monkeypatch):
+    # A fresh configuration with its queue, dedup table and spool under tmp_path
+    for name, value in {
+        'SENDGRID_API_KEY': 'test',
+        'OPENAI_API_KEY': 'test',
+        'SYSTEM_PROMPT': 'Be brief.',
+        'DEFAULT_MODEL_SLUG': 'gpt-4o',
+        'DEFAULT_PROVIDER': 'openai',
+        'WHITELISTED_EMAILS': 'jane@x.com',
+        'QUEUE_DB_PATH': str(tmp_path / 'queue.db'),
+        'QUEUE_SPOOL_DIR': str(tmp_path / 'spool'),
+        'QUEUE_CONCURRENCY': '{"openai": 2, "anthropic": 1}',
+        'QUEUE_LEASE_SECONDS': '60',
+        'QUEUE_MAX_ATTEMPTS': '3'
+    }.items():
+        monkeypatch.setenv(name, value)
+    config = load_configuration()
+    job_queue.init_queue(config)
+    dedup.init_dedup(config)
+    return config
@@ -0,0 +1,48 @@
+import asyncio
+import email_processor
+from completions import match_noreply, noreply_prefix_state
+
+def test_sentinel_at_the_start_is_matched():
+    assert match_noreply('NOREPLY') == 'NOREPLY'
+    assert match_noreply('"NOREPLY".') == 'NOREPLY'
+    assert match_noreply('NOREPLY - it\'s addressed to Bob') == 'NOREPLY'
+    assert match_noreply('NOREPLY\n\nThe question was for Bob.') == 'NOREPLY'
+    assert match_noreply('**NOREPLY_LOOPING**\n') == 'NOREPLY_LOOPING'
+
+def test_answers_mentioning_the_word_are_not_matched():
+    assert match_noreply('Noreply addresses are used for notifications.') is None
+    assert match_noreply('NOREPLYING is not a word.') is None
+    assert match_noreply('noreply') is None
+    assert match_noreply('Sure. NOREPLY is the sentinel I use.') is None
+
+def test_streaming_state():
+    assert noreply_prefix_state('') == 'pending'
+    assert noreply_prefix_state('NOREP') == 'pending'
+    assert noreply_prefix_state('NOREPLY') == 'pending'
+    assert noreply_prefix_state('NOREPLY_') == 'pending'
+    assert noreply_prefix_state('NOREPLYI') == 'no'
+    assert noreply_prefix_state('Noreply') == 'no'
+
+def test_streaming_check_agrees_with_final_check():
+    for text in ('NOREPLY\n', 'NOREPLY ', 'NOREPLY -', 'NOREPLY.', '`NOREPLY`', 'NOREPLY_LOOPING!', 'NOREPLYING', 'Noreply '):
+        assert (noreply_prefix_state(text) == 'match') == bool(match_noreply(text))
+
+def test_unstreamed_noreply_with_a_reason_is_not_sent(monkeypatch):
+    # The resume path returns the whole reply at once, without the streaming check
+    sent = []
+
+    async def fake_response(*args, **kwargs):
+        return "NOREPLY - reason"
+
+    async def fake_send(**kwargs):
+        sent.append(kwargs)
+        return True, "sent", 200
+
+    monkeypatch.setattr(email_processor, 'get_ai_response', fake_response)
+    monkeypatch.setattr(email_processor, 'send_email_response', fake_send)
+    success, message, status = asyncio.run(email_processor.reply_as_agent(
+        {'MODEL_MAPPING': {}}, 'gpt4o@agent.io', 'jane@x.com', 'gpt4o@agent.io, bob@x.com', 'Hi', 'Bob, can you?',
+        '<m1@x.com>', None, None, ''
+    ))
+    assert (success, message, status) == (True, "AI determined no reply was needed", 200)
+    assert not sent
@@ -0,0 +1,35 @@
+import threading
+import dedup
+
+def test_concurrent_deliveries_have_one_winner(config):
+    barrier = threading.Barrier(8)
+    results = []
+
+    def deliver():
+        barrier.wait()
+        results.append(dedup.claim_message(config, '<m1@x.com>', 'claude@agent.io'))
+
+    threads = [threading.Thread(target=deliver) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == [False] * 7 + [True]
+
+def test_claim_is_per_message_and_agent(config):
+    assert dedup.claim_message(config, '<m1@x.com>', 'claude@agent.io')
+    assert not dedup.claim_message(config, ' <m1@x.com> ', 'Claude@Agent.io')
+    assert dedup.claim_message(config, '<m1@x.com>', 'gpt4o@agent.io')
+    assert dedup.claim_message(config, '<m2@x.com>', 'claude@agent.io')
+
+def test_released_or_expired_claims_can_be_claimed_again(config):
+    assert dedup.claim_message(config, '<m1@x.com>', 'claude@agent.io')
+    dedup.release_message(config, '<m1@x.com>', 'claude@agent.io')
+    assert dedup.claim_message(config, '<m1@x.com>', 'claude@agent.io')
+
+    config['DEDUP_TTL_SECONDS'] = -1
+    assert dedup.claim_message(config, '<m1@x.com>', 'claude@agent.io')
+
+def test_messages_without_an_id_are_always_processed(config):
+    assert dedup.claim_message(config, None, 'claude@agent.io')
+    assert dedup.claim_message(config, None, 'claude@agent.io')
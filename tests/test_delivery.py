@@ -0,0 +1,34 @@
+import asyncio
+import httpx
+import pytest
+import delivery
+from config import EmailProcessingError
+
+@pytest.fixture
+def sendgrid(monkeypatch):
+    # A fake SendGrid that answers with the queued status codes, in order
+    monkeypatch.setenv('SENDGRID_API_KEY', 'test')
+    monkeypatch.setattr(delivery, '_retry_delay', lambda attempt, response=None: 0)
+    fake = {'statuses': [], 'requests': []}
+
+    def handler(request):
+        fake['requests'].append(request)
+        return httpx.Response(fake['statuses'].pop(0) if fake['statuses'] else 202)
+
+    delivery.set_transport(httpx.MockTransport(handler))
+    yield fake
+    delivery.set_transport(None)
+
+def test_send_retries_server_errors(sendgrid):
+    sendgrid['statuses'] = [500, 429]
+    response = asyncio.run(delivery.send_mail({'subject': 'Hi'}))
+    assert response.status_code == 202
+    assert len(sendgrid['requests']) == 3
+    assert sendgrid['requests'][0].headers['Authorization'] == 'Bearer test'
+
+def test_client_errors_are_not_retried(sendgrid):
+    sendgrid['statuses'] = [400]
+    with pytest.raises(EmailProcessingError) as error:
+        asyncio.run(delivery.send_mail({'subject': 'Hi'}))
+    assert error.value.status_code == 400
+    assert len(sendgrid['requests']) == 1
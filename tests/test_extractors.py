@@ -0,0 +1,25 @@
+import asyncio
+from extractors import extract_attachments, extract_text, find_extractor, share_budget
+
+CONFIG = {'EXTRACT_WORKERS': 2, 'EXTRACT_TIMEOUT': 30, 'EXTRACT_CACHE_SIZE': 10}
+
+def test_extractor_falls_back_to_the_file_extension():
+    assert find_extractor('data.csv', 'application/vnd.ms-excel')['name'] == 'text'
+    assert find_extractor('notes.md', 'application/octet-stream')['name'] == 'text'
+    assert find_extractor('archive.zip', 'application/zip') is None
+
+def test_text_extraction_stops_at_max_chars():
+    assert extract_text(b'a,b\n1,2\n', 100) == ('a,b\n1,2\n', False)
+    assert extract_text(b'x' * 500, 100) == ('x' * 100, True)
+
+def test_budget_is_shared_between_files():
+    assert share_budget([10, 1000, 50], 300) == [10, 240, 50]
+
+def test_extract_attachments():
+    attachments = [
+        {'filename': 'notes.md', 'content': b'# Notes\nhello', 'content_type': 'text/markdown'},
+        {'filename': 'blob.txt', 'content': b'\x00\x01', 'content_type': 'text/plain'}
+    ]
+    text = asyncio.run(extract_attachments(attachments, 100, CONFIG))
+    assert "[Attached file: notes.md]\n# Notes\nhello\n[End of notes.md]" in text
+    assert "[Attached file: blob.txt (could not read its contents)]" in text
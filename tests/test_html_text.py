@@ -0,0 +1,13 @@
+from html_text import html_to_text
+
+def test_head_without_end_tag_does_not_swallow_body():
+    assert html_to_text('<html><head><title>T</title><body><p>Real content</p>') == 'Real content'
+
+def test_hidden_paragraph_closed_by_next_paragraph():
+    assert html_to_text('<p style="display:none">preheader<p>Real content') == 'Real content'
+
+def test_hidden_list_item_keeps_its_nested_list_hidden():
+    assert html_to_text('<ul><li hidden>x<ul><li>y</li></ul></li><li>shown</ul>') == '- shown'
+
+def test_script_is_skipped_until_its_end_tag():
+    assert html_to_text('<script>if (a<b) { document.write("<p>x") }</script>ok') == 'ok'
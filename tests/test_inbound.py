@@ -0,0 +1,30 @@
+import io
+import os
+import sqlite3
+from werkzeug.datastructures import FileStorage, MultiDict
+from inbound import accept_inbound
+
+def make_form(sender):
+    return MultiDict({'from': sender, 'to': 'claude@agent.io', 'subject': 'Hi', 'text': 'Hello', 'Message-ID': '<m1@x.com>'})
+
+def make_files():
+    return MultiDict({'attachment1': FileStorage(io.BytesIO(b'a,b\n1,2\n'), filename='data.csv', content_type='text/csv')})
+
+def count(config, table):
+    conn = sqlite3.connect(config['QUEUE_DB_PATH'])
+    try:
+        return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    finally:
+        conn.close()
+
+def test_non_whitelisted_sender_is_rejected_before_any_work(config):
+    assert accept_inbound(config, make_form('Mallory <mallory@evil.com>'), make_files()) == ("Sender email not whitelisted", 403)
+    assert count(config, 'jobs') == 0
+    assert count(config, 'seen_messages') == 0
+    assert os.listdir(config['QUEUE_SPOOL_DIR']) == []
+
+def test_whitelisted_sender_is_queued_once(config):
+    assert accept_inbound(config, make_form('Jane <jane@x.com>'), make_files()) == ("OK", 200)
+    assert accept_inbound(config, make_form('Jane <jane@x.com>'), make_files()) == ("OK", 200)
+    assert count(config, 'jobs') == 1
+    assert len(os.listdir(config['QUEUE_SPOOL_DIR'])) == 1
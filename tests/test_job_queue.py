@@ -0,0 +1,103 @@
+import os
+import time
+import sqlite3
+import threading
+import job_queue
+
+def enqueue(config, provider='openai', payload=None):
+    job_id = job_queue.new_job_id()
+    job_queue.enqueue_job(config, job_id, provider, payload or {'subject': 'Hi', 'replied_agents': []})
+    return job_id
+
+def job_row(config, job_id):
+    conn = sqlite3.connect(config['QUEUE_DB_PATH'])
+    conn.row_factory = sqlite3.Row
+    try:
+        return conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    finally:
+        conn.close()
+
+def test_claim_skips_saturated_providers(config):
+    anthropic_job = enqueue(config, 'anthropic')
+    openai_job = enqueue(config, 'openai')
+    job = job_queue.claim_job(config, ['anthropic'])
+    assert job['id'] == openai_job
+    assert job_queue.claim_job(config, ['anthropic']) is None
+    assert job_queue.claim_job(config, [])['id'] == anthropic_job
+
+def test_running_job_is_not_claimed_until_its_lease_expires(config):
+    job_id = enqueue(config)
+    assert job_queue.claim_job(config, [])['attempts'] == 1
+    assert job_queue.claim_job(config, []) is None
+
+    # The worker holding it died: once the lease is up, another worker takes over
+    conn = sqlite3.connect(config['QUEUE_DB_PATH'])
+    conn.execute("UPDATE jobs SET available_at = ? WHERE id = ?", (time.time() - 1, job_id))
+    conn.commit()
+    conn.close()
+    job = job_queue.claim_job(config, [])
+    assert job['id'] == job_id
+    assert job['attempts'] == 2
+
+def test_extend_lease_keeps_the_job(config):
+    config['QUEUE_LEASE_SECONDS'] = 0
+    job_id = enqueue(config)
+    job_queue.claim_job(config, [])
+    config['QUEUE_LEASE_SECONDS'] = 60
+    job_queue.extend_lease(config, job_id)
+    assert job_queue.claim_job(config, []) is None
+
+def test_concurrent_workers_claim_each_job_once(config):
+    job_ids = {enqueue(config) for _ in range(20)}
+    claimed = []
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            job = job_queue.claim_job(config, [])
+            if job is None:
+                return
+            with lock:
+                claimed.append(job['id'])
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(claimed) == sorted(job_ids)
+
+def test_failed_job_keeps_its_progress_and_retries(config):
+    job_id = enqueue(config)
+    job = job_queue.claim_job(config, [])
+    job['payload']['replied_agents'] = ['claude@agent.io']
+    assert job_queue.fail_job(config, job, 'SendGrid timed out')
+
+    row = job_row(config, job_id)
+    assert row['status'] == 'pending'
+    assert row['available_at'] > time.time()
+    assert row['last_error'] == 'SendGrid timed out'
+
+    conn = sqlite3.connect(config['QUEUE_DB_PATH'])
+    conn.execute("UPDATE jobs SET available_at = 0 WHERE id = ?", (job_id,))
+    conn.commit()
+    conn.close()
+    assert job_queue.claim_job(config, [])['payload']['replied_agents'] == ['claude@agent.io']
+
+def test_job_fails_for_good_after_max_attempts(config):
+    job_id = enqueue(config)
+    os.makedirs(job_queue.job_spool_dir(config, job_id))
+    job = job_queue.claim_job(config, [])
+    job['attempts'] = config['QUEUE_MAX_ATTEMPTS']
+    assert not job_queue.fail_job(config, job, 'still broken')
+    assert job_row(config, job_id)['status'] == 'failed'
+    assert not os.path.exists(job_queue.job_spool_dir(config, job_id))
+    assert job_queue.claim_job(config, []) is None
+
+def test_completed_job_and_its_spool_are_removed(config):
+    job_id = enqueue(config)
+    os.makedirs(job_queue.job_spool_dir(config, job_id))
+    job_queue.claim_job(config, [])
+    job_queue.complete_job(config, job_id)
+    assert job_row(config, job_id) is None
+    assert not os.path.exists(job_queue.job_spool_dir(config, job_id))
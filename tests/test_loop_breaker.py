@@ -0,0 +1,40 @@
+import loop_breaker
+from recipients import Recipients
+
+MODEL_MAPPING = {'claude': {}, 'gpt4o': {}}
+
+def make_config(tmp_path):
+    return {
+        'QUEUE_DB_PATH': str(tmp_path / 'queue.db'),
+        'LOOP_MAX_AGENT_TURNS': 10,
+        'LOOP_MAX_FAST_TURNS': 5,
+        'LOOP_MIN_TURN_SECONDS': 30,
+        'LOOP_MAX_AGENT_TOKENS': 200000,
+        'LOOP_STATE_TTL_SECONDS': 7 * 24 * 3600
+    }
+
+def test_default_model_address_counts_as_an_agent():
+    agents = Recipients.parse('claude@agent.io', 'helper@agent.io').agent_addresses(MODEL_MAPPING)
+    assert loop_breaker.is_agent_sender('claude@agent.io', agents)
+    agents = Recipients.parse('helper@agent.io', 'claude@agent.io').agent_addresses(MODEL_MAPPING)
+    assert loop_breaker.is_agent_sender('helper@agent.io', agents)
+    assert not loop_breaker.is_agent_sender('jane@x.com', agents)
+
+def test_loop_with_a_default_model_address_trips(tmp_path):
+    config = make_config(tmp_path)
+    senders = ['claude@agent.io', 'helper@agent.io']
+    reasons = []
+    for turn in range(30):
+        sender, recipient = senders[turn % 2], senders[(turn + 1) % 2]
+        agents = Recipients.parse(sender, recipient).agent_addresses(MODEL_MAPPING)
+        agent_authored = loop_breaker.is_agent_sender(sender, agents)
+        reasons.append(loop_breaker.check_thread(config, '<root@x.com>', f'<m{turn}@x.com>', agent_authored))
+    # Fast turns trip first: five agent turns less than LOOP_MIN_TURN_SECONDS apart
+    assert reasons.index(next(r for r in reasons if r)) == 5
+    assert all(reasons[5:])
+
+def test_human_turn_resets_the_breaker(tmp_path):
+    config = make_config(tmp_path)
+    for turn in range(6):
+        loop_breaker.check_thread(config, '<root@x.com>', f'<m{turn}@x.com>', True)
+    assert loop_breaker.check_thread(config, '<root@x.com>', '<human@x.com>', False) is None
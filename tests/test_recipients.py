@@ -0,0 +1,15 @@
+from recipients import Recipients, parse_address_list
+
+def test_entries_that_are_not_addresses_are_dropped():
+    assert parse_address_list('Doe, Jane <jane@x.com>') == ['jane@x.com']
+    assert parse_address_list('undisclosed-recipients:;') == []
+
+def test_unparseable_entries_fall_back_to_extraction():
+    assert parse_address_list('Jane Doe jane@x.com') == ['jane@x.com']
+
+def test_quoted_display_names_with_commas():
+    assert parse_address_list('"Doe, Jane" <jane@x.com>, bob@y.com') == ['jane@x.com', 'bob@y.com']
+
+def test_reply_addresses_exclude_the_agent():
+    recipients = Recipients.parse('Doe, Jane <jane@x.com>', 'claude@mentat.com, Bob <bob@y.com>', 'gpt4o@mentat.com')
+    assert recipients.reply_addresses('claude@mentat.com') == (['jane@x.com', 'bob@y.com'], ['gpt4o@mentat.com'])
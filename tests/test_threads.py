@@ -0,0 +1,31 @@
+import asyncio
+from threads import parse_thread, render_thread, compact_thread
+from utils import estimate_tokens
+
+CONFIG = {'THREAD_SUMMARY_TOKENS': 150, 'MODEL_MAPPING': {}, 'THREAD_SUMMARY_MODEL': '', 'THREAD_SUMMARY_CACHE_SIZE': 100}
+
+def outlook_thread(count):
+    bodies = [f"Message {i} " + "lorem ipsum dolor sit amet " * 75 for i in range(count)]
+    return "\n\n-----Original Message-----\nFrom: x\nSent: y\n\n".join(bodies)
+
+def test_outlook_thread_is_split_at_original_message_lines():
+    messages = parse_thread(outlook_thread(5))
+    assert len(messages) == 5
+    assert all(message['level'] == 0 for message in messages)
+    assert messages[1]['header'] == '-----Original Message-----'
+
+def test_quoted_thread_round_trips():
+    text = "Sure.\n\nOn Mon, Bob <b@x.com> wrote:\n> Can we meet?\n>\n> On Sun, Alice <a@x.com> wrote:\n>> Hello"
+    messages = parse_thread(text)
+    assert [message['level'] for message in messages] == [0, 1, 2]
+    assert render_thread(messages) == text
+
+def test_outlook_thread_is_compacted():
+    result = asyncio.run(compact_thread(outlook_thread(20), 'outlook', 1000, CONFIG))
+    assert estimate_tokens(result) <= 1100
+    assert result.startswith("Message 0")
+
+def test_newest_message_over_budget_is_truncated():
+    result = asyncio.run(compact_thread("word " * 20000, 'long', 1000, CONFIG))
+    assert 900 <= estimate_tokens(result) <= 1100
+    assert result.endswith("[... rest of this message truncated]")
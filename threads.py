@@ -0,0 +1,212 @@
+# Mentat Mail: https://mentatmail.com
+# Copyright (C) 2025 Andy Bromberg andy@andybromberg.com
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import re
+import asyncio
+import hashlib
+from collections import OrderedDict
+import litellm
+from utils import debug_print, estimate_tokens
+
+# Every reply re-quotes the whole history, so without this the prompt grows
+# with each turn of a long thread. We split the body into messages by quote
+# level, drop repeated copies of the same message, and once the thread is over
+# the model's token budget we replace the oldest messages with short summaries.
+# Summaries are cached per thread, so each old message is only summarized once.
+
+QUOTE_PREFIX = re.compile(r'^((?:>\s?)+)')
+ATTRIBUTION = re.compile(r'(^On\s.+\bwrote:\s*$)|(^-+\s*Original Message\s*-+\s*$)', re.IGNORECASE)
+DEDUP_MIN_CHARS = 200
+
+_summary_cache = OrderedDict()
+
+def thread_root(references, message_id=None):
+    if references:
+        return references.split()[0]
+    return message_id
+
+def _split_quote(line):
+    match = QUOTE_PREFIX.match(line)
+    if not match:
+        return 0, line
+    return match.group(1).count('>'), line[match.end():]
+
+def parse_thread(text):
+    # Returns [{'level', 'header', 'header_level', 'lines'}], newest first, in
+    # the order they appear in the email. Messages are split where the quote
+    # level changes, and also at an attribution line ("On ... wrote:",
+    # "-----Original Message-----") within one level, which is how Outlook
+    # threads without ">" quoting are laid out.
+    messages = []
+    current = None
+    for raw_line in text.split('\n'):
+        level, line = _split_quote(raw_line.rstrip())
+        if current is not None and level == current['level'] and ATTRIBUTION.search(line.strip()) \
+                and any(l.strip() for l in current['lines']):
+            current = {'level': level, 'header': line.strip(), 'header_level': level, 'lines': []}
+            messages.append(current)
+            continue
+        if current is None or (level != current['level'] and line.strip()):
+            header, header_level = None, None
+            # "On ... wrote:" belongs to the message it introduces, not the one above it
+            if current is not None and level > current['level']:
+                while current['lines'] and not current['lines'][-1].strip():
+                    current['lines'].pop()
+                if current['lines'] and ATTRIBUTION.search(current['lines'][-1].strip()):
+                    header, header_level = current['lines'].pop().strip(), current['level']
+                elif not current['lines'] and current['header_level'] == current['level']:
+                    # An attribution split off above that introduces this quote instead
+                    header, header_level = current['header'], current['header_level']
+                    messages.pop()
+            current = {'level': level, 'header': header, 'header_level': header_level, 'lines': []}
+            messages.append(current)
+        current['lines'].append(line)
+
+    for message in messages:
+        while message['lines'] and not message['lines'][-1].strip():
+            message['lines'].pop()
+        while message['lines'] and not message['lines'][0].strip():
+            message['lines'].pop(0)
+    return [message for message in messages if message['lines'] or message['header']]
+
+def _body(message):
+    return '\n'.join(message['lines'])
+
+def _fingerprint(text):
+    return hashlib.sha256(' '.join(text.lower().split()).encode('utf-8')).hexdigest()
+
+def dedupe_messages(messages):
+    seen = set()
+    unique = []
+    for message in messages:
+        body = _body(message)
+        if len(body) >= DEDUP_MIN_CHARS:
+            fingerprint = _fingerprint(body)
+            if fingerprint in seen:
+                continue
+            seen.add(fingerprint)
+        unique.append(message)
+    return unique
+
+def render_thread(messages):
+    lines = []
+    for message in messages:
+        prefix = '>' * message['level']
+        header_prefix = '>' * message['header_level'] if message['header'] else prefix
+        if lines:
+            lines.append(header_prefix if message['header'] else prefix)
+        if message['header']:
+            lines.append(f"{header_prefix} {message['header']}".strip())
+        for line in message['lines']:
+            lines.append(f"{prefix} {line}" if prefix and line.strip() else (prefix or line))
+    return '\n'.join(lines)
+
+def _truncate(message, max_tokens):
+    # Keeps the top of a message (the part written last) within max_tokens
+    lines = []
+    room = max_tokens * 4
+    for line in message['lines']:
+        if len(line) >= room:
+            if room > 0:
+                lines.append(line[:room].rsplit(' ', 1)[0])
+            break
+        lines.append(line)
+        room -= len(line) + 1
+    return dict(message, lines=lines + ["[... rest of this message truncated]"])
+
+def _excerpt(text, max_tokens):
+    max_chars = max_tokens * 4
+    text = ' '.join(text.split())
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars].rsplit(' ', 1)[0] + ' ...'
+
+async def _llm_summary(text, summary_model, max_tokens):
+    api_key = os.getenv(f"{summary_model.get('provider', '').upper()}_API_KEY", os.getenv('OPENAI_API_KEY'))
+    response = await litellm.acompletion(
+        model=summary_model.get('model'),
+        messages=[
+            {"role": "system", "content": f"Summarize this email in at most {max_tokens // 2} words. Keep names, decisions, questions and numbers. Reply with the summary only."},
+            {"role": "user", "content": text}
+        ],
+        api_key=api_key
+    )
+    return response.choices[0].message.content.strip()
+
+async def summarize_message(thread_id, message, config):
+    body = _body(message)
+    key = (thread_id, _fingerprint(body))
+    if key in _summary_cache:
+        _summary_cache.move_to_end(key)
+        return _summary_cache[key]
+
+    max_tokens = config['THREAD_SUMMARY_TOKENS']
+    summary_model = config['MODEL_MAPPING'].get(config['THREAD_SUMMARY_MODEL'] or '')
+    summary = None
+    if summary_model:
+        try:
+            summary = await _llm_summary(body, summary_model, max_tokens)
+        except Exception as e:
+            debug_print(f"Thread summary failed, falling back to an excerpt: {str(e)}")
+    if not summary:
+        summary = _excerpt(body, max_tokens)
+
+    _summary_cache[key] = summary
+    while len(_summary_cache) > config['THREAD_SUMMARY_CACHE_SIZE']:
+        _summary_cache.popitem(last=False)
+    return summary
+
+async def compact_thread(text, thread_id, token_budget, config):
+    if estimate_tokens(text) <= token_budget:
+        return text
+
+    messages = dedupe_messages(parse_thread(text))
+    # Spend the budget newest-first: shallowest quote level first, and top to
+    # bottom within a level. The newest message is always kept, truncated only
+    # if it alone is over the budget.
+    order = sorted(range(len(messages)), key=lambda i: messages[i]['level'])
+    remaining = token_budget
+    to_summarize = []
+    for i in order:
+        cost = estimate_tokens(_body(messages[i]))
+        if i == order[0] and cost > remaining:
+            messages[i] = _truncate(messages[i], remaining)
+            cost = estimate_tokens(_body(messages[i]))
+        if i == order[0] or cost <= remaining:
+            remaining -= cost
+        else:
+            to_summarize.append(i)
+
+    summaries = await asyncio.gather(*[summarize_message(thread_id, messages[i], config) for i in to_summarize])
+    omitted = 0
+    for i, summary in zip(to_summarize, summaries):
+        cost = estimate_tokens(summary)
+        if cost <= remaining:
+            remaining -= cost
+            messages[i] = dict(messages[i], lines=[f"[Summary of an earlier message] {summary}"])
+        else:
+            messages[i] = None
+            omitted += 1
+
+    compacted = [message for message in messages if message is not None]
+    if omitted:
+        deepest = max(message['level'] for message in compacted)
+        compacted.append({'level': deepest + 1, 'header': None, 'lines': [f"[{omitted} older message(s) omitted]"]})
+
+    result = render_thread(compacted)
+    debug_print(f"Compacted thread {thread_id}: ~{estimate_tokens(text)} -> ~{estimate_tokens(result)} tokens ({len(to_summarize)} summarized, {omitted} omitted)")
+    return result
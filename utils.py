@@ -16,41 +16,90 @@
 
 import os
 import re
+import sys
+import queue
+import atexit
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime
 
+_log_listener = None
+_log_lock = threading.Lock()
+
+def get_logger():
+    # Records are handed to a background thread that does the writing, so a
+    # slow stdout never holds up a request or the event loop
+    global _log_listener
+    logger = logging.getLogger('mentat')
+    if _log_listener is None:
+        with _log_lock:
+            if _log_listener is None:
+                log_queue = queue.SimpleQueue()
+                handler = logging.StreamHandler(sys.stdout)
+                handler.setFormatter(logging.Formatter('%(message)s'))
+                _log_listener = QueueListener(log_queue, handler)
+                _log_listener.start()
+                atexit.register(_log_listener.stop)
+                logger.addHandler(QueueHandler(log_queue))
+                logger.setLevel(logging.DEBUG)
+                logger.propagate = False
+    return logger
+
 def debug_print(*args, **kwargs):
-    if os.getenv('FLASK_DEBUG') == '1':
-        print(*args, **kwargs)
+    if os.getenv('FLASK_DEBUG') != '1':
+        return
+    message = kwargs.get('sep', ' ').join(str(arg) for arg in args)
+    # Whole form bodies and LLM replies end up in here; keep each line bounded
+    max_chars = int(os.getenv('LOG_MAX_CHARS', '2000'))
+    if max_chars and len(message) > max_chars:
+        message = f"{message[:max_chars]}... [{len(message) - max_chars} more characters]"
+    get_logger().debug(message)
+
+def estimate_tokens(text):
+    # Rough and cheap: ~4 characters per token
+    return len(text) // 4
+
+BRACKETED_EMAIL = re.compile(r'<([^<>]+@[^<>]+)>')
+BARE_EMAIL = re.compile(r'[\w\.-]+@[\w\.-]+\.\w+')
 
 def extract_email(email_string):
-    bracket_match = re.findall(r'<([^<>]+@[^<>]+)>', email_string)
+    bracket_match = BRACKETED_EMAIL.findall(email_string)
     if bracket_match:
         return bracket_match[-1].strip()
     
-    email_match = re.findall(r'[\w\.-]+@[\w\.-]+\.\w+', email_string)
+    email_match = BARE_EMAIL.findall(email_string)
     if email_match:
         return email_match[-1].strip()
     
     return email_string.strip()
 
-def is_email_whitelisted(email, whitelisted_emails):
-    email = email.lower()
-    email_domain = email.split('@')[1] if '@' in email else ''
-
+def compile_whitelist(whitelisted_emails):
+    allow_all = False
+    emails = set()
+    domains = set()
     for whitelisted_email in whitelisted_emails:
-        if whitelisted_email == '*' or whitelisted_email == '*@*' or whitelisted_email == '*@*.*':
-            return True
+        if whitelisted_email in ('*', '*@*', '*@*.*'):
+            allow_all = True
+            continue
         whitelisted_email = whitelisted_email.lower()
-
         if whitelisted_email.startswith('*@'):
-            whitelisted_domain = whitelisted_email[2:]
-            if email_domain == whitelisted_domain:
-                return True
-            
-        elif email == whitelisted_email:
-            return True
-    
-    return False
+            domains.add(whitelisted_email[2:])
+        else:
+            emails.add(whitelisted_email)
+    return {'allow_all': allow_all, 'emails': frozenset(emails), 'domains': frozenset(domains)}
+
+def is_email_whitelisted(email, whitelist):
+    if not isinstance(whitelist, dict):
+        whitelist = compile_whitelist(whitelist)
+    if whitelist['allow_all']:
+        return True
+
+    email = email.lower()
+    if email in whitelist['emails']:
+        return True
+    email_domain = email.split('@')[1] if '@' in email else ''
+    return email_domain in whitelist['domains']
 
 def format_quoted_text(text_content, from_email):
     original_text = text_content.strip()